@@ -0,0 +1,135 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import time
+
+from functools import wraps
+from redis.exceptions import ConnectionError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a service that keeps failing. After max_failures
+    consecutive failures it opens, rejecting every call at once, and after
+    reset seconds it lets a single trial call through, half-open. The
+    trial closes it again when it succeeds and reopens it on any error.
+    """
+
+    def __init__(self, name, max_failures, reset):
+        self.name = name
+        self.max_failures = max_failures
+        self.reset = reset
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        # Counters since the process started
+        self.calls = 0
+        self.rejected = 0
+        self.total_failures = 0
+        self.opened = 0
+
+    def allow(self):
+        if self.state == OPEN and time.time() - self.opened_at >= self.reset:
+            self.state = HALF_OPEN
+            return True
+        if self.state == CLOSED:
+            return True
+        self.rejected += 1
+        return False
+
+    def ready(self):
+        """Whether allow would let a call through, without counting it"""
+        if self.state == OPEN:
+            return time.time() - self.opened_at >= self.reset
+        return self.state == CLOSED
+
+    def succeeded(self):
+        self.calls += 1
+        self.failures = 0
+        self.state = CLOSED
+
+    def failed(self):
+        self.calls += 1
+        self.failures += 1
+        self.total_failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.max_failures:
+            if self.state != OPEN:
+                self.opened += 1
+            self.state = OPEN
+            self.opened_at = time.time()
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'failures': self.failures,
+            'max_failures': self.max_failures,
+            'reset': self.reset,
+            'calls': self.calls,
+            'rejected': self.rejected,
+            'total_failures': self.total_failures,
+            'opened': self.opened,
+        }
+
+
+def _guarded_(breaker, f):
+    @wraps(f)
+    def guarded(*args, **kwargs):
+        if not breaker.allow():
+            raise ConnectionError("%s circuit is open" % breaker.name)
+        try:
+            result = f(*args, **kwargs)
+        except ConnectionError:
+            breaker.failed()
+            raise
+        except BaseException:
+            # Redis answered with an error, or the call was interrupted: a
+            # half-open trial has to settle anyway, or the breaker would
+            # reject every call from then on
+            if breaker.state == HALF_OPEN:
+                breaker.failed()
+            else:
+                breaker.succeeded()
+            raise
+        breaker.succeeded()
+        return result
+    return guarded
+
+
+class GuardedRedis(object):
+    """
+    Redis client whose commands go through breaker, failing with a
+    ConnectionError without touching the network while it is open.
+    Pipelines only reach redis on execute, the one call guarded for them.
+    """
+
+    def __init__(self, client, breaker):
+        self.client = client
+        self.breaker = breaker
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self.client.pipeline(*args, **kwargs)
+        pipe.execute = _guarded_(self.breaker, pipe.execute)
+        return pipe
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+        return _guarded_(self.breaker, attr)
@@ -23,9 +23,16 @@ from simplenet.common.config import get_logger
 logger = get_logger()
 
 def on_message(body, message):
-    logger.info("Received ack for %s from %s" % (body.get("id"), body.get("device")))
     fw = Net()
-    fw.policy_ack(body.get("id"))
+    if body.get("resync"):
+        logger.info("Received resync request from %s" % body.get("device"))
+        fw.ruleset_resync(body.get("device"))
+    elif body.get("version"):
+        logger.info("Received ack for ruleset %s from %s" % (body.get("version"), body.get("device")))
+        fw.ruleset_ack(body.get("device"), body.get("version"))
+    else:
+        logger.info("Received ack for %s from %s" % (body.get("id"), body.get("device")))
+        fw.policy_ack(body.get("id"))
     message.ack()
 
 def callback_run():
@@ -20,78 +20,144 @@
 import socket
 
 from kombu import BrokerConnection, Exchange, Queue
+from kombu.pools import ProducerPool
+from kombu.serialization import encode
 
 from simplenet.common.config import config, get_logger
 
 logger = get_logger()
 
+# Producers kept per broker url, each holding an open connection, shared
+# by every greenlet of the process
+POOL_SIZE = 10
+# Reconnections tried by a publish before giving up
+RETRY_POLICY = {'max_retries': 3, 'interval_start': 0, 'interval_step': 1, 'interval_max': 2}
+
+_pools = {}
+# (exchange, queue) names declared on the broker by this process, see
+# EventManager._publish_
+_declared = set()
+# Payloads smaller than this many bytes are sent uncompressed
+COMPRESS_MIN = 1024
+
+def _event_option_(option, default):
+    if config.has_option('event', option) and config.get('event', option).strip():
+        return config.get('event', option).strip()
+    return default
+
+def _serializer_():
+    serializer = _event_option_('serializer', 'json')
+    if serializer == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            logger.warn("msgpack is not installed, publishing events as json")
+            return 'json'
+    return serializer
+
+def _producers_(url):
+    pool = _pools.get(url)
+    if pool is None:
+        connections = BrokerConnection(url).Pool(POOL_SIZE)
+        pool = _pools[url] = ProducerPool(connections, limit=POOL_SIZE)
+    return pool
+
 class EventManager(object):
     def __init__(self):
         self.url = config.get("event", "broker")
+        self.serializer = _serializer_()
+        self.compression = _event_option_('compression', None)
+        self.compress_min = int(_event_option_('compress_min', COMPRESS_MIN))
+
+    def _encode_(self, params):
+        """
+        Returns the publish arguments of params, serialized as configured
+        and compressed when big enough for it to pay off. Agents read both
+        from the message properties, json being the default.
+        """
+        content_type, content_encoding, body = encode(params, serializer=self.serializer)
+        encoded = {'body': body, 'content_type': content_type,
+                   'content_encoding': content_encoding}
+        if self.compression and len(body) >= self.compress_min:
+            encoded['compression'] = self.compression
+        return encoded
+
+    def _publish_(self, params, exchange, routing_key, queue=None):
+        """
+        Publishes params through a pooled producer, encoded by _encode_.
+        The exchange and queue are only declared the first time, then
+        publishing is a single write. Lost connections are reopened, up to
+        RETRY_POLICY.
+        """
+        key = (exchange.name, queue.name if queue else None)
+        declare = [] if key in _declared else [x for x in (exchange, queue) if x]
+        encoded = self._encode_(params)
+        try:
+            with _producers_(self.url).acquire(block=True) as producer:
+                logger.debug("Publishing %s" % params)
+                producer.publish(exchange=exchange, routing_key=routing_key,
+                                 declare=declare, retry=True,
+                                 retry_policy=RETRY_POLICY, **encoded)
+        except Exception:
+            # The broker may have lost what was declared
+            _declared.clear()
+            raise
+        _declared.add(key)
 
     def raise_fanout_event(self, exchange, event_type, params, **kwargs):
         logger.debug("Raising event %s with params: %s" % (event_type, params))
-        with BrokerConnection(self.url) as conn:
-            conn.ensure_connection()
-
-            media_exchange = Exchange(
-                    "dhcp:fanout:%s" % exchange,
-                    type="fanout",
-                    durable=True)
+        media_exchange = Exchange(
+                "dhcp:fanout:%s" % exchange,
+                type="fanout",
+                durable=True)
+
+        if 'route' in kwargs:
+            routing_key = kwargs['route']
+        else:
+            queue = Queue(
+                    event_type,
+                    exchange=media_exchange,
+                    routing_key=event_type
+            )
 
-            if 'route' in kwargs:
-                routing_key = kwargs['route']
-            else:
-                queue = Queue(
-                        event_type,
-                        exchange=media_exchange,
-                        routing_key=event_type
-                )
-
-                if params['action'] == 'new' or params['action'] == 'rebuild_queues':
-                    queue(conn.channel()).declare()
-                    return
-                elif params['action'] == 'remove':
+            if params['action'] == 'new' or params['action'] == 'rebuild_queues':
+                with _producers_(self.url).acquire(block=True) as producer:
+                    queue(producer.channel).declare()
+                _declared.add((media_exchange.name, queue.name))
+                return
+            elif params['action'] == 'remove':
+                _declared.discard((media_exchange.name, queue.name))
+                with _producers_(self.url).acquire(block=True) as producer:
                     try:
-                        queue(conn.channel()).unbind()
+                        queue(producer.channel).unbind()
                     except AttributeError:
-                        queue(conn.channel()).unbind_from(exchange=media_exchange, routing_key=event_type)
-                    return
-                else:
-                    routing_key = event_type
+                        queue(producer.channel).unbind_from(exchange=media_exchange, routing_key=event_type)
+                return
+            else:
+                routing_key = event_type
 
-            with conn.Producer(exchange=media_exchange, serializer="json",
-                               routing_key=routing_key) as producer:
-                    logger.debug("Publishing %s" % params)
-                    producer.publish(params)
+        self._publish_(params, media_exchange, routing_key)
 
 
     def raise_event(self, event_type, params, **kwargs):
         logger.debug("Raising event %s with params: %s" % (event_type, params))
-        with BrokerConnection(self.url) as conn:
-            conn.ensure_connection()
-
-            media_exchange = Exchange(
-                    "simplenet",
-                    type="direct",
-                    durable=True)
-
-            if 'route' in kwargs:
-                routing_key = kwargs['route']
-            else:
-                queue = Queue(
-                        event_type,
-                        exchange=media_exchange,
-                        routing_key=event_type
-                )
-
-                queue(conn.channel()).declare()
-                routing_key = event_type
+        media_exchange = Exchange(
+                "simplenet",
+                type="direct",
+                durable=True)
+
+        queue = None
+        if 'route' in kwargs:
+            routing_key = kwargs['route']
+        else:
+            queue = Queue(
+                    event_type,
+                    exchange=media_exchange,
+                    routing_key=event_type
+            )
+            routing_key = event_type
 
-            with conn.Producer(exchange=media_exchange, serializer="json",
-                               routing_key=routing_key) as producer:
-                    logger.debug("Publishing %s" % params)
-                    producer.publish(params)
+        self._publish_(params, media_exchange, routing_key, queue)
 
     def listen_event(self, queue_name, callback):
         with BrokerConnection(self.url) as conn:
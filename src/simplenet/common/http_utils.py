@@ -18,11 +18,18 @@
 # @author: Luiz Ozaki, Locaweb.
 
 import redis
+import time
 
 from functools import wraps
-from bottle import response, request, abort
+from itertools import chain
+from types import GeneratorType
+from bottle import response, request, abort, hook
 
-from simplenet.common.config import get_logger
+from simplenet.common import lpm
+from simplenet.common.breaker import CircuitBreaker, GuardedRedis
+from simplenet.common.config import config, get_logger
+from simplenet.common.lru import LRUCache
+from simplenet.db import db_utils
 import hashlib
 
 try:
@@ -32,12 +39,122 @@ except ImportError:
 
 logger = get_logger()
 
+def _cache_option_(option, default):
+    if config.has_option('server', option) and config.get('server', option).strip():
+        return config.getfloat('server', option)
+    return default
+
+# Largest page a list route hands out when limit or cursor is given
+PAGE_LIMIT = 1000
+# Bytes of JSON gathered before a streamed response writes a chunk
+STREAM_CHUNK = 65536
+# Values of the view query param, full is the to_dict of each entry
+VIEWS = ('full', 'summary')
+# Resource -> resources its responses are built from. A cached list goes
+# stale when any of them is written, see invalidate.
+CACHE_DEPENDS = {
+    'datacenters': ('datacenters',),
+    'zones': ('zones', 'datacenters'),
+    'vlans': ('vlans', 'zones'),
+    'subnets': ('subnets', 'vlans', 'ips', 'interfaces'),
+    'anycasts': ('anycasts',),
+    'ips': ('ips', 'subnets', 'interfaces'),
+    'anycastips': ('anycastips', 'anycasts'),
+    'dhcps': ('dhcps',),
+    'interfaces': ('interfaces', 'vlans', 'switches', 'ips', 'subnets'),
+    'firewalls': ('firewalls', 'zones'),
+    'routers': ('routers', 'zones'),
+    'switches': ('switches',),
+}
+# Fields of a response holding the id of another entity it is built from
+TAG_FIELDS = {
+    'datacenter_id': 'datacenters',
+    'zone_id': 'zones',
+    'vlan_id': 'vlans',
+    'subnet_id': 'subnets',
+    'anycast_id': 'anycasts',
+    'interface_id': 'interfaces',
+    'switch_id': 'switches',
+}
+# Seconds a cached response is still served once its ttl is over, while
+# the worker holding its lock builds it again
+CACHE_STALE = 60
+# Seconds the lock of a response being built is held at most
+CACHE_LOCK_TTL = 10
+# Seconds a worker missing a response waits for the one building it, and
+# how often it looks for it meanwhile
+CACHE_LOCK_WAIT = 2
+CACHE_LOCK_POLL = 0.05
+# Bytes of JSON an unpaginated list may reach and still be cached. Bigger
+# ones are streamed, with CACHE_TOO_BIG stored in their place so the other
+# workers stream them too rather than wait for them.
+CACHE_STREAM_BYTES = 1024 * 1024
+CACHE_TOO_BIG = "too-big"
+# Bounds of the in-process copy of the cache, kept in front of redis, and
+# seconds an entry lives there at most
+CACHE_LOCAL_ENTRIES = 10000
+CACHE_LOCAL_BYTES = 64 * 1024 * 1024
+CACHE_LOCAL_TTL = 30
+# Redis channel invalidations are broadcast on, see cache_listener
+CACHE_CHANNEL = "simplenet.cache.invalidations"
+# Seconds a cache command waits for redis, and consecutive failures after
+# which the cache leaves redis alone for CACHE_BREAKER_RESET seconds
+CACHE_SOCKET_TIMEOUT = _cache_option_('cache_socket_timeout', 0.25)
+CACHE_BREAKER_FAILURES = int(_cache_option_('cache_breaker_failures', 3))
+CACHE_BREAKER_RESET = _cache_option_('cache_breaker_reset', 10)
+
+# Redis client of the cache. While redis fails the breaker opens and
+# requests go straight to the database instead of waiting on timeouts.
+redis_breaker = CircuitBreaker('redis', CACHE_BREAKER_FAILURES, CACHE_BREAKER_RESET)
+cache_redis = GuardedRedis(redis.Redis(socket_timeout=CACHE_SOCKET_TIMEOUT), redis_breaker)
+# Methods served by a read only database session
+READ_METHODS = ('GET', 'HEAD')
+
+
+@hook('before_request')
+def open_session():
+    db_utils.open_request_session(read_only=request.method in READ_METHODS)
+
+
+@hook('after_request')
+def close_session():
+    # A streamed body is still reading from it, stream_json closes it. Failed
+    # requests skip this hook, their session goes with the next request of
+    # the greenlet or with the greenlet itself.
+    if not request.environ.get('simplenet.stream'):
+        db_utils.close_request_session()
+
+
+def stream_json(items):
+    """Yields items as a JSON array, a chunk of about STREAM_CHUNK bytes at a time"""
+    chunk, size, separator = ['['], 1, ''
+    try:
+        for item in items:
+            item = dumps(item)
+            chunk.extend((separator, item))
+            size += len(item) + 1
+            separator = ','
+            if size >= STREAM_CHUNK:
+                yield ''.join(chunk)
+                chunk, size = [], 0
+    except Exception:
+        # The status is already sent, the truncated array tells the client
+        logger.exception("Failed to stream response")
+        raise
+    finally:
+        db_utils.close_request_session()
+    chunk.append(']')
+    yield ''.join(chunk)
+
 
 def reply_json(f):
     @wraps(f)
     def json_dumps(*args, **kwargs):
         r = f(*args, **kwargs)
         response.content_type = "application/json; charset=UTF-8"
+        if type(r) is GeneratorType:
+            request.environ['simplenet.stream'] = True
+            return stream_json(r)
         if r and type(r) in (dict, list, tuple):
             return dumps(r)
         if r and type(r) is str:
@@ -49,7 +166,7 @@ def create_manager(network_appliance):
     _module_ = "simplenet.network_appliances.%s" % network_appliance
     module = __import__(_module_)
     module = getattr(module.network_appliances, network_appliance)
-    return module.Net()
+    return module.Net(db_utils.request_session())
 
 
 def validate_input(src="query", *vargs, **vkwargs):
@@ -105,33 +222,377 @@ def validate_input(src="query", *vargs, **vkwargs):
         return validate
     return proxy
 
-def clear_cache(rd=None):
-    # TODO: Better cache
-    if not rd:
-        rd = redis.Redis()
+def info_args():
+    """
+    Keyword arguments of the manager info methods for an info route: the
+    fields and view query params, when given
+    """
+    args = {}
+    fields = request.query.get('fields')
+    if fields:
+        args['fields'] = tuple(x.strip() for x in fields.split(',') if x.strip())
+    view = request.query.get('view')
+    if view:
+        if view not in VIEWS:
+            abort(400, "view must be one of %s" % ', '.join(VIEWS))
+        args['view'] = view
+    return args
+
+def list_args():
+    """
+    Keyword arguments of the manager list methods for a list route: limit
+    and cursor when the client paginates, stream otherwise, along with
+    the ones of info_args
+    """
+    args = info_args()
+    limit = request.query.get('limit')
+    cursor = request.query.get('cursor')
+    if limit is None and cursor is None:
+        args['stream'] = True
+        return args
+    try:
+        limit = int(limit or PAGE_LIMIT)
+    except ValueError:
+        abort(400, "limit must be an integer")
+    if not 0 < limit <= PAGE_LIMIT:
+        abort(400, "limit must be between 1 and %s" % PAGE_LIMIT)
+    args.update({'limit': limit, 'cursor': cursor or None})
+    return args
+
+def _generation_key_(resource):
+    return "simplenet.cache.generation.%s" % resource
+
+def _tag_key_(resource, id):
+    return "simplenet.cache.tag.%s.%s" % (resource, id)
+
+def _children_key_(resource, id):
+    return "simplenet.cache.children.%s.%s" % (resource, id)
+
+def _response_tags_(resource, response):
+    """
+    Tag keys of a response showing single entities: the ones of each
+    entity, of the entities its TAG_FIELDS point to and of its children,
+    which it may list. None when the response is not made of entities.
+    """
+    items = response if type(response) is list else [response]
+    if not items or not all(type(x) is dict and x.get('id') for x in items):
+        return None
+    tags = set()
+    for item in items:
+        tags.add(_tag_key_(resource, item['id']))
+        tags.add(_children_key_(resource, item['id']))
+        tags.update(_tag_key_(TAG_FIELDS[x], item[x]) for x in TAG_FIELDS if item.get(x))
+    return tags
+
+def invalidate(resources, entities=(), parents=()):
+    """
+    Makes stale the cached lists built from resources, by bumping their
+    generations, and drops the cached responses showing any of entities or
+    listing the children of any of parents, (resource, id) pairs.
+    Registered in db_utils.commit_listeners, it runs with what each
+    transaction wrote.
+
+    Invalidations failing on redis are kept in _unapplied and redone
+    before the cache is used again, see _replay_.
+    """
+    # Only those resources are cached
+    resources = [x for x in resources if x in CACHE_DEPENDS]
+    entities = [x for x in entities if x[0] in CACHE_DEPENDS]
+    parents = [x for x in parents if x[0] in CACHE_DEPENDS]
+    if not (resources or entities or parents):
+        return
+    rd = cache_redis
+    try:
+        tags = [_tag_key_(*x) for x in entities] + [_children_key_(*x) for x in parents]
+        pipe = rd.pipeline(transaction=False)
+        for tag in tags:
+            pipe.smembers(tag)
+        keys = set(chain(*pipe.execute()))
+        keys.update(tags)
+        if keys:
+            pipe.delete(*keys)
+        for resource in resources:
+            pipe.incr(_generation_key_(resource))
+        message = {'keys': list(keys), 'resources': resources}
+        pipe.publish(CACHE_CHANNEL, dumps(message))
+        pipe.execute()
+        _drop_local_(message)
+    except redis.exceptions.RedisError, e:
+        logger.error("Failed to invalidate the cache of %s: %s" % (', '.join(resources), e))
+        _unapplied['resources'].update(resources)
+        _unapplied['entities'].update(entities)
+        _unapplied['parents'].update(parents)
+        _drop_local_(None)
+
+db_utils.commit_listeners.append(invalidate)
+
+_unapplied = {'resources': set(), 'entities': set(), 'parents': set()}
+
+def _replay_():
+    """
+    Redoes the invalidations that failed, once redis may answer again.
+    Returns whether none is left, the cache being usable.
+    """
+    if not any(_unapplied.values()):
+        return True
+    if redis_breaker.ready():
+        resources, entities, parents = [list(_unapplied[x]) for x in ('resources', 'entities', 'parents')]
+        for x in _unapplied.values():
+            x.clear()
+        invalidate(resources, entities, parents)
+    return not any(_unapplied.values())
+
+def clear_cache(*resources):
+    """
+    Makes every cached list built from resources stale, all of them when
+    none is given. Entries are keyed by the generations of the resources
+    they were built with, so the stale ones are no longer looked up and
+    expire on their own.
+    """
+    invalidate(resources or CACHE_DEPENDS.keys())
+
+# In-process copy of the cache. Only used while cache_listener is
+# subscribed, an entry being dropped from it by any process invalidating
+# the entry in redis.
+_local = LRUCache(CACHE_LOCAL_ENTRIES, CACHE_LOCAL_BYTES)
+_local_state = {'listening': False, 'drops': 0}
+
+def _drop_local_(message):
+    """
+    Drops the local entries invalidated by message, all of them when None.
+    The prefix indexes of the cidrs written go along, see lpm.expire.
+    """
+    _local_state['drops'] += 1
+    if message is None:
+        _local.clear()
+        lpm.expire()
+    else:
+        _local.drop(message['keys'], message['resources'])
+        lpm.expire(message['resources'])
+
+def cache_listener():
+    """Keeps the local cache subscribed to the invalidations of every process"""
+    while True:
+        try:
+            pubsub = redis.Redis().pubsub()
+            pubsub.subscribe(CACHE_CHANNEL)
+            for message in pubsub.listen():
+                if message['type'] == 'subscribe':
+                    _local_state['listening'] = True
+                elif message['type'] == 'message':
+                    _drop_local_(loads(message['data']))
+        except Exception:
+            logger.exception("Lost the cache invalidation channel")
+        # Invalidations got missed meanwhile
+        _local_state['listening'] = False
+        _drop_local_(None)
+        time.sleep(1)
+
+# Counters of the response cache since the process started, see cache_stats
+_stats = dict.fromkeys((
+    'hits', 'local_hits', 'misses', 'stale_served', 'builds', 'build_seconds',
+    'build_max', 'lock_waits', 'lock_wait_seconds', 'lock_wait_max',
+    'lock_wait_hits', 'lock_wait_timeouts', 'too_big', 'errors'), 0)
+
+def cache_stats():
+    stats = dict(_stats)
+    stats['local_listening'] = _local_state['listening']
+    stats['local_entries'] = len(_local.entries)
+    stats['local_bytes'] = _local.size
+    stats['local_evictions'] = _local.evictions
+    stats['redis'] = redis_breaker.to_dict()
+    stats['unapplied_invalidations'] = sum(len(x) for x in _unapplied.values())
+    stats['build_avg'] = stats['build_seconds'] / (stats['builds'] or 1)
+    stats['lock_wait_avg'] = stats['lock_wait_seconds'] / (stats['lock_waits'] or 1)
+    return stats
+
+def _timed_(counter, start):
+    seconds = time.time() - start
+    _stats['%s_seconds' % counter] += seconds
+    _stats['%s_max' % counter] = max(_stats['%s_max' % counter], seconds)
+
+def _lock_(rd, key):
+    """
+    Takes the lock building the response cached under key, if free. Only
+    the taker sets its ttl, so polling does not keep it alive, and a lock
+    left without one by a taker dying in between gets it from the others.
+    """
+    lock = "%s.lock" % key
+    pipe = rd.pipeline(transaction=True)
+    pipe.setnx(lock, 1)
+    pipe.ttl(lock)
+    locked, ttl = pipe.execute()
+    if locked or ttl in (None, -1):
+        rd.expire(lock, CACHE_LOCK_TTL)
+    return locked
+
+def _wait_(rd, key):
+    """
+    Waits up to CACHE_LOCK_WAIT for the worker holding the lock of key to
+    store it, and returns the entry, or None when it did not
+    """
+    start = time.time()
+    _stats['lock_waits'] += 1
     try:
-        rd.delete(*rd.keys("simplenet.cache.*"))
-    except redis.exceptions.ResponseError:
-        pass
+        while time.time() - start < CACHE_LOCK_WAIT:
+            time.sleep(CACHE_LOCK_POLL)
+            entry = rd.get(key)
+            if entry:
+                _stats['lock_wait_hits'] += 1
+                return entry
+            if not rd.exists("%s.lock" % key):
+                return rd.get(key)
+        _stats['lock_wait_timeouts'] += 1
+    finally:
+        _timed_('lock_wait', start)
 
-def cache(ttl=300, rd=None):
+def _buffer_stream_(items):
+    """
+    Returns the JSON array of the streamed items when it is at most
+    CACHE_STREAM_BYTES long, or a generator of every item otherwise
+    """
+    buffered, encoded, size = [], [], 2
+    for item in items:
+        buffered.append(item)
+        encoded.append(dumps(item))
+        size += len(encoded[-1]) + 1
+        if size > CACHE_STREAM_BYTES:
+            return (x for x in chain(buffered, items))
+    return "[%s]" % ','.join(encoded)
+
+def cache(ttl=300, rd=None, resource=None, tagged=False):
+    """
+    Caches the response of a GET route for ttl seconds. It belongs to
+    resource, taken from the resource route argument when not given.
+
+    Responses are keyed by the generations of the CACHE_DEPENDS of
+    resource, so any write to one of those makes them stale. Tagged
+    responses, the ones about single entities, are instead kept in the tag
+    sets of the entities they show and only dropped when one of those, or
+    one of their children, is written, see invalidate.
+
+    A single worker builds a missing or expired response, the one taking
+    its lock. Meanwhile the others serve the expired one for up to
+    CACHE_STALE seconds, or wait for the new one when there is none.
+
+    Fresh responses are also kept in process, for up to CACHE_LOCAL_TTL
+    seconds, grouped by the resources they are built from. That copy is
+    looked up first and needs no redis round trip.
+
+    Responses are built from the primary database, read only requests
+    reading from a replica otherwise.
+
+    Unpaginated lists are cached too, up to CACHE_STREAM_BYTES of JSON,
+    and streamed past that, see _buffer_stream_.
+
+    Cached responses are returned as the json string they are stored as,
+    which reply_json sends untouched, so it must be the next decorator.
+
+    When redis fails, or has invalidations of this process left to
+    apply, responses are built without the cache.
+    """
     if not rd:
-        rd = redis.Redis()
+        rd = cache_redis
     def proxy(f):
         @wraps(f)
         def caching(*args, **kwargs):
-            _hash = "simplenet.cache.%s-%s" % (f.__name__, hashlib.md5("%s%s" % (
+            _resource = resource or kwargs.get('resource')
+            if _resource not in CACHE_DEPENDS or not _replay_():
+                return f(*args, **kwargs)
+            depends = [_generation_key_(x) for x in CACHE_DEPENDS[_resource]]
+            key = lambda generations: "simplenet.cache.%s-%s" % (f.__name__, hashlib.md5("%s%s%s%s" % (
                 repr(args[1:]),
-                repr(kwargs)
+                repr(sorted(kwargs.items())),
+                request.query_string,
+                generations
             )).hexdigest())
+            # Tagged entries are dropped by key, lists by the resources
+            # they depend on
+            local_key, groups = key(None), () if tagged else CACHE_DEPENDS[_resource]
+            local = _local_state['listening']
+            drops = _local_state['drops']
+            if local:
+                data = _local.get(local_key)
+                if data is not None:
+                    _stats['local_hits'] += 1
+                    return data
+
+            locked = False
             try:
-                cache = rd.get(_hash)
-                if not cache:
-                    cache = dumps(f(*args, **kwargs))
-                    rd.setex(_hash, cache, ttl)
-                return loads(cache)
-            except Exception, e:
+                generations = None if tagged else rd.mget(depends)
+                _hash = key(generations)
+                entry = rd.get(_hash)
+                if entry == CACHE_TOO_BIG:
+                    _stats['too_big'] += 1
+                    return f(*args, **kwargs)
+                if entry:
+                    fresh_until, data = entry.split('|', 1)
+                    fresh = float(fresh_until) - time.time()
+                    if fresh > 0:
+                        _stats['hits'] += 1
+                        if local and drops == _local_state['drops']:
+                            _local.set(local_key, data, min(fresh, CACHE_LOCAL_TTL), groups)
+                        return data
+                    locked = _lock_(rd, _hash)
+                    if not locked:
+                        _stats['stale_served'] += 1
+                        return data
+                else:
+                    _stats['misses'] += 1
+                    locked = _lock_(rd, _hash)
+                    if not locked:
+                        entry = _wait_(rd, _hash)
+                        if entry == CACHE_TOO_BIG:
+                            return f(*args, **kwargs)
+                        if entry:
+                            return entry.split('|', 1)[1]
+                if tagged:
+                    generations = rd.mget(depends)
+            except redis.exceptions.RedisError:
+                _stats['errors'] += 1
                 return f(*args, **kwargs)
+
+            try:
+                start = time.time()
+                # A replica may not have the write that invalidated the
+                # entry yet, and would keep it stale for the whole ttl
+                db_utils.read_from_primary()
+                result = f(*args, **kwargs)
+                if type(result) is GeneratorType:
+                    result = _buffer_stream_(result)
+                    if type(result) is GeneratorType:
+                        _stats['too_big'] += 1
+                        rd.setex(_hash, CACHE_TOO_BIG, ttl)
+                        return result
+                _stats['builds'] += 1
+                _timed_('build', start)
+                tags = ()
+                if tagged:
+                    tags = _response_tags_(_resource, result)
+                    # An entity written while this was built may be stale in it
+                    if not tags or rd.mget(depends) != generations:
+                        return result
+                data = result if type(result) is str else dumps(result)
+                pipe = rd.pipeline(transaction=False)
+                pipe.setex(_hash, "%.3f|%s" % (time.time() + ttl, data), ttl + CACHE_STALE)
+                for tag in tags:
+                    pipe.sadd(tag, _hash)
+                    pipe.expire(tag, ttl + CACHE_STALE)
+                pipe.execute()
+                # Nothing got invalidated while it was built
+                if local and drops == _local_state['drops']:
+                    _local.set(local_key, data, min(ttl, CACHE_LOCAL_TTL), groups)
+                result = data
+            except redis.exceptions.RedisError:
+                _stats['errors'] += 1
+                logger.exception("Failed to cache %s" % f.__name__)
+            finally:
+                if locked:
+                    try:
+                        rd.delete("%s.lock" % _hash)
+                    except redis.exceptions.RedisError:
+                        pass
+            return result
         return caching
     return proxy
 
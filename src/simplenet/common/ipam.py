@@ -0,0 +1,110 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from ipaddr import IPAddress
+
+WORD = 64
+FULL = (1 << WORD) - 1
+
+# subnet id -> SubnetBitmap, shared by every manager of this process
+bitmaps = {}
+
+
+class SubnetBitmap(object):
+    """
+    Occupancy bitmap of the addresses of a subnet.
+
+    Words are kept in a dict and only the ones with a bit set are stored,
+    so an almost empty IPv6 /64 costs as little as an IPv4 /24.
+    """
+
+    def __init__(self, network):
+        self.base = int(network.network)
+        self.size = network.numhosts
+        self.version = network.version
+        self.words = {}
+        # Every word below hint is full
+        self.hint = 0
+        self.set(0)
+        self.set(int(network.ip) + 1 - self.base)
+        if self.version == 4 and network.prefixlen < 31:
+            self.set(self.size - 1)
+
+    def offset(self, ip):
+        return int(IPAddress(ip)) - self.base
+
+    def address(self, offset):
+        return str(IPAddress(self.base + offset, self.version))
+
+    def set(self, offset):
+        if 0 <= offset < self.size:
+            index, bit = divmod(offset, WORD)
+            self.words[index] = self.words.get(index, 0) | (1 << bit)
+
+    def clear(self, offset):
+        index, bit = divmod(offset, WORD)
+        word = self.words.get(index, 0) & ~(1 << bit)
+        if word:
+            self.words[index] = word
+        else:
+            self.words.pop(index, None)
+        self.hint = min(self.hint, index)
+
+    def load(self, ips):
+        for ip in ips:
+            self.set(self.offset(ip))
+
+    def occupy(self, ip):
+        self.set(self.offset(ip))
+
+    def release(self, ip):
+        self.clear(self.offset(ip))
+
+    def reserve(self, count):
+        """Marks and returns the offsets of the first count free addresses"""
+        found = []
+        index = self.hint
+        while len(found) < count and index * WORD < self.size:
+            free = ~self.words.get(index, 0) & FULL
+            if not free and index == self.hint:
+                self.hint += 1
+            while free and len(found) < count:
+                low = free & -free
+                offset = index * WORD + low.bit_length() - 1
+                if offset >= self.size:
+                    break
+                found.append(offset)
+                free ^= low
+            index += 1
+        for offset in found:
+            self.set(offset)
+        return found
+
+
+def occupy(subnet_id, ips):
+    bitmap = bitmaps.get(subnet_id)
+    if bitmap:
+        bitmap.load(ips)
+
+
+def release(subnet_id, ips):
+    bitmap = bitmaps.get(subnet_id)
+    if bitmap:
+        for ip in ips:
+            bitmap.release(ip)
+
+
+def forget(subnet_id):
+    bitmaps.pop(subnet_id, None)
@@ -0,0 +1,166 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import time
+
+from ipaddr import IPAddress, IPNetwork
+
+# Seconds an index is trusted before checking the version of its cidrs
+# again. Writes of other processes expire it sooner, see expire.
+VERSION_TTL = 5
+
+
+class Node(object):
+
+    __slots__ = ('prefix', 'plen', 'value', 'children')
+
+    def __init__(self, prefix, plen, value=None):
+        self.prefix = prefix
+        self.plen = plen
+        self.value = value
+        self.children = [None, None]
+
+
+class Trie(object):
+    """
+    Path compressed binary trie (patricia) of the prefixes of one ip
+    version. Only prefixes and branching points get a node, so a lookup
+    visits at most one node per distinct prefix length on its path.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.root = Node(0, 0)
+
+    def _bit_(self, number, index):
+        return (number >> (self.width - index - 1)) & 1
+
+    def _common_(self, a, b, limit):
+        diff = (a ^ b) >> (self.width - limit)
+        return limit - diff.bit_length()
+
+    def insert(self, prefix, plen, value):
+        node = self.root
+        while True:
+            if node.plen == plen:
+                node.value = value
+                return
+            bit = self._bit_(prefix, node.plen)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = Node(prefix, plen, value)
+                return
+            common = self._common_(child.prefix, prefix, min(child.plen, plen))
+            if common == child.plen:
+                node = child
+                continue
+            if common == plen:
+                new = Node(prefix, plen, value)
+            else:
+                mask = ((1 << common) - 1) << (self.width - common)
+                new = Node(prefix & mask, common)
+                new.children[self._bit_(prefix, common)] = Node(prefix, plen, value)
+            new.children[self._bit_(child.prefix, common)] = child
+            node.children[bit] = new
+            return
+
+    def remove(self, prefix, plen):
+        path = []
+        node = self.root
+        while node is not None and node.plen < plen:
+            bit = self._bit_(prefix, node.plen)
+            path.append((node, bit))
+            node = node.children[bit]
+        if node is None or node.plen != plen or node.prefix != prefix:
+            return
+        node.value = None
+        # Drop the emptied node and any glue node left with a single child
+        while path and node.value is None:
+            children = [x for x in node.children if x is not None]
+            if len(children) == 2:
+                break
+            parent, bit = path.pop()
+            parent.children[bit] = children[0] if children else None
+            node = parent
+
+    def lookup(self, number):
+        best = None
+        node = self.root
+        width = self.width
+        while node is not None:
+            if (number ^ node.prefix) >> (width - node.plen):
+                break
+            if node.value is not None:
+                best = node.value
+            if node.plen == width:
+                break
+            node = node.children[(number >> (width - node.plen - 1)) & 1]
+        return best
+
+
+class PrefixIndex(object):
+    """
+    Longest prefix match of addresses against a set of cidrs. version is
+    the one of the cidrs it holds, None until loaded, for the processes
+    to tell when another one changed them. It is only compared with the
+    database once expired.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.version = None
+        self.checked_until = 0
+        self.tries = {4: Trie(32), 6: Trie(128)}
+
+    def clear(self):
+        self.version = None
+        self.checked_until = 0
+        self.tries = {4: Trie(32), 6: Trie(128)}
+
+    def expired(self):
+        return time.time() >= self.checked_until
+
+    def checked(self, version):
+        """Records version as the current one of the cidrs"""
+        self.version = version
+        self.checked_until = time.time() + VERSION_TTL
+
+    def add(self, cidr, value):
+        network = IPNetwork(cidr)
+        self.tries[network.version].insert(
+            int(network.network), network.prefixlen, value
+        )
+
+    def remove(self, cidr):
+        network = IPNetwork(cidr)
+        self.tries[network.version].remove(
+            int(network.network), network.prefixlen
+        )
+
+    def lookup(self, ip):
+        address = IPAddress(ip)
+        return self.tries[address.version].lookup(int(address))
+
+
+# Shared by every manager of this process, see SimpleNet._prefix_index_
+subnets = PrefixIndex('subnets')
+anycasts = PrefixIndex('anycasts')
+
+
+def expire(names=None):
+    """Makes the next lookups check the indexes named, all when None"""
+    for index in (subnets, anycasts):
+        if names is None or index.name in names:
+            index.checked_until = 0
@@ -0,0 +1,90 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least recently used cache of strings bounded by entry count and by
+    the sum of their lengths. Entries expire on their own and can belong
+    to groups, to be dropped all at once.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        # group -> keys of its entries
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._forget_(key, entry)
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value, ttl, groups=()):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self._forget_(key, old)
+            self.entries[key] = (time.time() + ttl, value, tuple(groups))
+            self.size += len(value)
+            for group in groups:
+                self.groups.setdefault(group, set()).add(key)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                oldest, entry = self.entries.popitem(last=False)
+                self._forget_(oldest, entry)
+                self.evictions += 1
+
+    def drop(self, keys=(), groups=()):
+        with self.lock:
+            keys = set(keys)
+            for group in groups:
+                keys.update(self.groups.get(group, ()))
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self._forget_(key, entry)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.groups.clear()
+            self.size = 0
+
+    def _forget_(self, key, entry):
+        # entry is already out of self.entries
+        self.size -= len(entry[1])
+        for group in entry[2]:
+            keys = self.groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.groups[group]
@@ -0,0 +1,175 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import threading
+import time
+
+from simplenet.common import event
+from simplenet.common.config import get_logger
+from simplenet.db import db_utils
+from simplenet.db.models import OutboxEvent
+
+logger = get_logger()
+
+# Events published per transaction of the dispatcher
+DISPATCH_BATCH = 100
+# Seconds the dispatcher waits for new events when the outbox is drained,
+# it is woken up at once by the ones written in this process
+DISPATCH_POLL = 1
+# Seconds a dispatcher has to publish the events it claimed before other
+# dispatchers may take them over
+DISPATCH_LEASE = 120
+# A failed event is retried after 2 ** n seconds, the nth attempt, RETRY_MAX
+# at most, for as long as it takes: dropping it would leave agents out of
+# date for good. Failures past ALERT_ATTEMPTS are logged as errors.
+RETRY_MAX = 60
+ALERT_ATTEMPTS = 10
+
+_wake = threading.Event()
+
+
+class EventOutbox(object):
+    """
+    EventManager of the network appliances. Events are stored in the
+    event_outbox table, in the transaction of session when one is open,
+    and published by the dispatcher once committed, so writes never wait
+    on the broker.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def raise_event(self, event_type, params, **kwargs):
+        self._store_(kwargs.get('route', event_type), 'raise_event',
+                     [event_type, params], kwargs)
+
+    def raise_fanout_event(self, exchange, event_type, params, **kwargs):
+        # Queues of a fanout exchange get all of its events
+        self._store_("dhcp:fanout:%s" % exchange, 'raise_fanout_event',
+                     [exchange, event_type, params], kwargs)
+
+    def _store_(self, routing_key, method, args, kwargs):
+        logger.debug("Storing %s event to %s: %s" % (method, routing_key, args))
+        self.session.begin(subtransactions=True)
+        try:
+            self.session.add(OutboxEvent(routing_key, method, json.dumps([args, kwargs])))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+
+def _claim_(session, now):
+    """
+    Leases the oldest DISPATCH_BATCH events that can be published now to
+    the calling dispatcher. An event is held back while an earlier one with
+    its routing key waits for a retry or is claimed by another dispatcher,
+    so each key keeps its order. Rows are only locked for the claim.
+    """
+    session.begin()
+    try:
+        waiting = session.query(OutboxEvent.routing_key).filter(
+            (OutboxEvent.retry_at > now) | (OutboxEvent.claimed_until > now)
+        ).distinct().all()
+        query = session.query(OutboxEvent)
+        if waiting:
+            query = query.filter(~OutboxEvent.routing_key.in_([x[0] for x in waiting]))
+        events = query.order_by(OutboxEvent.id).with_lockmode('update').limit(DISPATCH_BATCH).all()
+
+        claimed, held = [], set()
+        for outbox_event in events:
+            # Rechecked on the locked rows, another dispatcher may have
+            # claimed some since they were read
+            if outbox_event.retry_at > now or outbox_event.claimed_until > now:
+                held.add(outbox_event.routing_key)
+            if outbox_event.routing_key in held:
+                continue
+            outbox_event.claimed_until = now + DISPATCH_LEASE
+            claimed.append((outbox_event.id, outbox_event.routing_key,
+                            outbox_event.method, outbox_event.payload,
+                            outbox_event.attempts))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return claimed
+
+
+def dispatch(session, manager):
+    """
+    Publishes the events claimed by _claim_ through manager, in order, out
+    of any transaction, then deletes them. The first failure ends the
+    batch: the failed event is retried later and the ones after it are
+    released. Returns how many events were published.
+    """
+    now = int(time.time())
+    claimed = _claim_(session, now)
+
+    done, failed = [], None
+    for event_id, routing_key, method, payload, attempts in claimed:
+        args, kwargs = json.loads(payload)
+        try:
+            getattr(manager, method)(*args, **kwargs)
+        except Exception, e:
+            failed = event_id
+            log = logger.error if attempts + 1 >= ALERT_ATTEMPTS else logger.warn
+            log("Failed to publish event %s to %s, attempt %s, retrying: %s" % (
+                event_id, routing_key, attempts + 1, e))
+            break
+        done.append(event_id)
+
+    released = [x[0] for x in claimed if x[0] not in done]
+    session.begin()
+    try:
+        if done:
+            session.query(OutboxEvent).filter(OutboxEvent.id.in_(done)).delete(
+                synchronize_session=False)
+        if released:
+            session.query(OutboxEvent).filter(OutboxEvent.id.in_(released)).update(
+                {OutboxEvent.claimed_until: 0}, synchronize_session=False)
+        if failed:
+            outbox_event = session.query(OutboxEvent).get(failed)
+            outbox_event.attempts += 1
+            outbox_event.retry_at = now + min(2 ** outbox_event.attempts, RETRY_MAX)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return len(done)
+
+
+def dispatcher():
+    """Publishes the events of the outbox for ever: run it in its own thread"""
+    manager = event.EventManager()
+    session = db_utils.get_database_session()
+    while True:
+        _wake.clear()
+        try:
+            done = dispatch(session, manager)
+        except Exception:
+            logger.exception("Failed to dispatch the event outbox")
+            done = 0
+        finally:
+            session.close()
+        if done < DISPATCH_BATCH:
+            _wake.wait(DISPATCH_POLL)
+
+
+def _written_(tables, rows, parents):
+    if OutboxEvent.__tablename__ in tables:
+        _wake.set()
+
+db_utils.commit_listeners.append(_written_)
@@ -16,14 +16,79 @@
 # @author: Juliano Martinez (ncode), Locaweb.
 # @author: Luiz Ozaki, Locaweb.
 
-from sqlalchemy.orm import sessionmaker
+import time
+
+from itertools import chain
+
+from sqlalchemy import event
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker, scoped_session, object_mapper, Session
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
 from simplenet.db import models
 from simplenet.common.config import get_logger
 
 logger = get_logger()
 
+# Seconds a failing replica is left out before reads try it again
+REPLICA_RETRY = 30
+
 _engine = models.engine
 _maker = None
+_replicas = models.replicas
+# replica -> time until which it is left out
+_down = {}
+# replica -> time until which it is trusted without a probe
+_probed = {}
+_next = [0]
+
+# Called with the tables written by every committed transaction, the
+# (table, id) of the rows it wrote and of their parents, see written
+commit_listeners = []
+
+def written(session, tables=(), rows=(), parents=()):
+    """
+    Records tables and rows, along with the parents whose children were
+    added, changed or removed, as written by the transaction of session.
+    Rows flushed by the ORM are recorded on their own, the parents being
+    the rows their foreign keys point to before and after the flush;
+    writes bypassing it have to call this.
+    """
+    if not getattr(session, '_written_', None):
+        session._written_ = (set(), set(), set())
+    session._written_[0].update(tables)
+    session._written_[1].update(rows)
+    session._written_[2].update(parents)
+
+def _after_flush_(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        mapper = object_mapper(obj)
+        table = mapper.local_table.name
+        key = mapper.primary_key_from_instance(obj)
+        parents = []
+        for column in mapper.local_table.columns:
+            for fk in column.foreign_keys:
+                history = get_history(obj, mapper.get_property_by_column(column).key,
+                                      passive=PASSIVE_NO_INITIALIZE)
+                parents.extend((fk.column.table.name, x) for x in history.sum() if x)
+        written(session, [table], [(table, key[0])] if len(key) == 1 else [], parents)
+
+def _after_commit_(session):
+    tables, rows, parents = getattr(session, '_written_', None) or ((), (), ())
+    session._written_ = None
+    if tables:
+        for listener in commit_listeners:
+            try:
+                listener(tables, rows, parents)
+            except Exception:
+                logger.exception("Failed to handle the writes of a transaction")
+
+def _after_rollback_(session):
+    session._written_ = None
+
+event.listen(Session, 'after_flush', _after_flush_)
+event.listen(Session, 'after_commit', _after_commit_)
+event.listen(Session, 'after_rollback', _after_rollback_)
 
 def get_database_session(autocommit=True, expire_on_commit=True):
     global _maker, _engine
@@ -34,7 +99,120 @@ def get_database_session(autocommit=True, expire_on_commit=True):
                               expire_on_commit=expire_on_commit)
     return _maker()
 
+def _replica_down_(replica):
+    logger.warn("Replica %s failed, reading from the primary for %ss" % (
+        replica.url.host or replica.url.database, REPLICA_RETRY))
+    _down[replica] = time.time() + REPLICA_RETRY
+
+def _watch_replica_(replica):
+    def dbapi_error(conn, cursor, statement, parameters, context, exception):
+        if isinstance(exception, conn.dialect.dbapi.OperationalError):
+            _replica_down_(replica)
+    event.listen(replica, 'dbapi_error', dbapi_error)
+
+for replica in _replicas:
+    _watch_replica_(replica)
+
+def replica_engine():
+    """
+    Engine reads go to: the replicas in turn, skipping the ones that
+    failed in the last REPLICA_RETRY seconds, or the primary when none
+    is left. A replica is probed with a connection at most once every
+    REPLICA_RETRY seconds, failing queries leave it out in between.
+    """
+    now = time.time()
+    for x in range(len(_replicas)):
+        replica = _replicas[_next[0] % len(_replicas)]
+        _next[0] += 1
+        if _down.get(replica, 0) > now:
+            continue
+        if _probed.get(replica, 0) <= now:
+            try:
+                replica.connect().close()
+            except DBAPIError:
+                _replica_down_(replica)
+                continue
+            _probed[replica] = now + REPLICA_RETRY
+        return replica
+    return _engine
+
+# Session of the request being served. The registry is a threading.local,
+# which gevent's monkey patching turns into one local per greenlet, so
+# concurrent requests never share a session or its identity map.
+request_session = scoped_session(sessionmaker(bind=_engine, autocommit=True))
+
+def open_request_session(read_only=False):
+    """
+    Replaces the session of the current greenlet by a new one. Nothing
+    gets written by a read only request, so its session reads from a
+    replica and neither flushes before queries nor expires what it
+    loaded. Writes, and whatever a write request reads back, stay on the
+    primary.
+    """
+    request_session.remove()
+    if read_only:
+        return request_session(bind=replica_engine(), autoflush=False,
+                               expire_on_commit=False)
+    return request_session(expire_on_commit=True)
+
+def read_from_primary():
+    """
+    Moves the reads of the session of the current greenlet to the primary,
+    for what must not lag behind the last writes. Only done before it
+    started a transaction.
+    """
+    session = request_session()
+    if session.bind is not _engine and not session.transaction:
+        session.bind = _engine
+    return session
+
+def close_request_session():
+    """Closes the session of the current greenlet, rolling back what is left open"""
+    request_session.remove()
+
 def unregister_database_models(base):
     global _engine
     assert _engine
     base.metadata.drop_all(_engine)
+
+def upgrade_database():
+    """
+    Brings a database created by an older release up to the models. The
+    missing tables are created along with the models, see models; this
+    adds the missing columns and indexes of the existing ones, then fills
+    the columns of the rows created before them. Columns are added
+    nullable and the ones no model uses are left alone.
+    """
+    inspector = Inspector.from_engine(_engine)
+    preparer = _engine.dialect.identifier_preparer
+    for table in models.Base.metadata.sorted_tables:
+        columns = set(x['name'] for x in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                logger.info("Adding column %s.%s" % (table.name, column.name))
+                _engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    preparer.format_table(table), preparer.format_column(column),
+                    column.type.compile(dialect=_engine.dialect)))
+        indexes = set(x['name'] for x in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                logger.info("Creating index %s" % index.name)
+                index.create(_engine)
+    logger.info("Filling the address ranges of older subnets, anycasts and ips")
+    fill_ip_numbers()
+
+def fill_ip_numbers():
+    """Fills the address range columns of rows created before they existed"""
+    session = get_database_session()
+    session.begin()
+    try:
+        for model in (models.Subnet, models.Anycast):
+            for x in session.query(model).filter(model.first == None):
+                x.cidr = x.cidr
+        for model in (models.Ip, models.Anycastip):
+            for x in session.query(model).filter(model.number == None):
+                x.ip = x.ip
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
@@ -20,19 +20,38 @@ import uuid
 
 from ipaddr import IPv4Network, IPv4Address, IPv6Network, IPv6Address, IPNetwork, IPAddress
 
-from sqlalchemy import event, Column, Integer, String, Boolean, create_engine, ForeignKey
+from sqlalchemy import event, Column, Integer, String, Text, Boolean, create_engine, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.schema import UniqueConstraint, Index
+from sqlalchemy.orm import relationship, backref, joinedload, subqueryload
 
 from simplenet.common.config import config
+from simplenet.db import pool
 
 Base = declarative_base()
 
+# Models list in summary_fields the to_dict keys they store as plain
+# columns. Those make up ?view=summary and can be read with column-only
+# selects, without building the objects or touching their relationships.
+#
+# load_options holds, per view, the loader options covering every
+# relationship the view reads, so listing n entries costs a fixed number
+# of queries instead of 1 + n. Many-to-one relationships are joined,
+# collections get their own subquery.
+
 def new_model(model_name):
     model = globals()[model_name]
     return model, model.__tablename__
 
+def ip_number(address):
+    """
+    Sortable key of an address: the ip version followed by its 128-bit
+    number as fixed width hex, so range queries compare the same on every
+    database backend.
+    """
+    address = IPAddress(address)
+    return '%d%032x' % (address.version, int(address))
+
 class Prober(Base):
 
     __tablename__ = 'prober'
@@ -43,6 +62,7 @@ class Prober(Base):
 class Datacenter(Base):
 
     __tablename__ = 'datacenters'
+    summary_fields = ('id', 'name')
 
     id = Column(String(36), primary_key=True)
     name = Column(String(255), unique=True)
@@ -62,6 +82,8 @@ class Datacenter(Base):
 class Zone(Base):
 
     __tablename__ = 'zones'
+    summary_fields = ('id', 'name', 'datacenter_id')
+    load_options = {'full': (joinedload('datacenter'),)}
 
     id = Column(String(36), primary_key=True)
     name = Column(String(255), unique=True)
@@ -88,6 +110,7 @@ class Zone(Base):
 class Dhcp(Base):
 
     __tablename__ = 'dhcps'
+    summary_fields = ('id', 'name')
 
     id = Column(String(36), primary_key=True)
     name = Column(String(255), unique=True)
@@ -110,6 +133,8 @@ class Dhcp(Base):
 class Vlans_to_Dhcp(Base):
 
     __tablename__ = 'vlans_to_dhcps'
+    summary_fields = ('vlan_id', 'dhcp_id')
+    load_options = {'full': (joinedload('vlan'), joinedload('dhcp'))}
 
     vlan_id = Column(String(36), ForeignKey('vlans.id'), primary_key=True)
     dhcp_id = Column(String(36), ForeignKey('dhcps.id'), primary_key=True)
@@ -128,6 +153,8 @@ class Vlans_to_Dhcp(Base):
 class Firewall(Base):
 
     __tablename__ = 'firewalls'
+    summary_fields = ('id', 'name', 'zone_id', 'mac', 'address', 'status')
+    load_options = {'full': (joinedload('zone'),)}
 
     id = Column(String(36), primary_key=True)
     name = Column(String(255), unique=True)
@@ -181,6 +208,8 @@ class Firewall(Base):
 class Router(Base):
 
     __tablename__ = 'routers'
+    summary_fields = ('id', 'name', 'zone_id', 'mac', 'address', 'status')
+    load_options = {'full': (joinedload('zone'),)}
 
     id = Column(String(36), primary_key=True)
     name = Column(String(255), unique=True)
@@ -233,6 +262,7 @@ class Router(Base):
 class Switch(Base):
 
     __tablename__ = 'switches'
+    summary_fields = ('id', 'name', 'model_type', 'mac', 'address')
 
     id = Column(String(36), primary_key=True)
     name = Column(String(255), unique=True)
@@ -272,6 +302,9 @@ class Switch(Base):
 class Interface(Base):
 
     __tablename__ = 'interfaces'
+    summary_fields = ('id', 'name', 'hostname', 'vlan_id', 'switch_id')
+    load_options = {'full': (joinedload('vlan'), joinedload('switch'),
+                             subqueryload('ips'), joinedload('ips.subnet'))}
 
     id = Column(String(36), primary_key=True, unique=True)
     switch_id = Column(String(36), ForeignKey('switches.id'))
@@ -311,6 +344,8 @@ class Interface(Base):
 class Vlan(Base):
 
     __tablename__ = 'vlans'
+    summary_fields = ('id', 'name', 'type', 'vlan_num', 'zone_id')
+    load_options = {'full': (joinedload('zone'),)}
 
     id = Column(String(36), primary_key=True)
     name = Column(String(255), unique=True)
@@ -352,6 +387,8 @@ class Vlan(Base):
 class Anycasts_to_Firewall(Base):
 
     __tablename__ = 'anycasts_to_firewalls'
+    summary_fields = ('anycast_id',)
+    load_options = {'full': (joinedload('anycast'),)}
 
     anycast_id = Column(String(36), ForeignKey('anycasts.id'), primary_key=True)
     firewall_id = Column(String(36), ForeignKey('firewalls.id'), primary_key=True)
@@ -368,6 +405,8 @@ class Anycasts_to_Firewall(Base):
 class Subnet(Base):
 
     __tablename__ = 'subnets'
+    summary_fields = ('id', 'cidr', 'vlan_id')
+    load_options = {'full': (joinedload('vlan'), subqueryload('ip'), joinedload('ip.interface'))}
 
     id = Column(String(36), primary_key=True)
     cidr = Column(String(255), unique=True)
@@ -375,6 +414,10 @@ class Subnet(Base):
     vlan_id = Column(String(36), ForeignKey('vlans.id'))
     vlan = relationship('Vlan', backref="subnet")
     ip = relationship('Ip')
+    first = Column(String(33))
+    last = Column(String(33))
+
+    __table_args__ = (Index('ix_subnets_range', 'first', 'last'),)
 
     def __init__(self, cidr, vlan_id, description=''):
         self.id = str(uuid.uuid4())
@@ -423,9 +466,12 @@ class Subnet(Base):
 class Ip(Base):
 
     __tablename__ = 'ips'
+    summary_fields = ('id', 'ip', 'subnet_id', 'interface_id')
+    load_options = {'full': (joinedload('subnet'), joinedload('interface'))}
 
     id = Column(String(36), primary_key=True)
     ip = Column(String(255), unique=True)
+    number = Column(String(33), index=True)
     description = Column(String(255))
     subnet_id = Column(String(36), ForeignKey('subnets.id'))
     subnet = relationship('Subnet')
@@ -463,10 +509,15 @@ class Ip(Base):
 class Anycast(Base):
 
     __tablename__ = 'anycasts'
+    summary_fields = ('id', 'cidr')
 
     id = Column(String(36), primary_key=True)
     cidr = Column(String(255), unique=True)
     description = Column(String(255))
+    first = Column(String(33))
+    last = Column(String(33))
+
+    __table_args__ = (Index('ix_anycasts_range', 'first', 'last'),)
 
     def __init__(self, cidr, description=''):
         self.id = str(uuid.uuid4())
@@ -497,9 +548,12 @@ class Anycast(Base):
 class Anycastip(Base):
 
     __tablename__ = 'anycastips'
+    summary_fields = ('id', 'ip', 'anycast_id')
+    load_options = {'full': (joinedload('anycast'),)}
 
     id = Column(String(36), primary_key=True)
     ip = Column(String(255), unique=True)
+    number = Column(String(33), index=True)
     description = Column(String(255))
     anycast_id = Column(String(36), ForeignKey('anycasts.id'))
     anycast = relationship('Anycast')
@@ -524,6 +578,8 @@ class Anycastip(Base):
 class Policy(Base):
 
     __tablename__ = 'policies'
+    summary_fields = ('id', 'owner_id', 'proto', 'src', 'src_port', 'dst', 'dst_port',
+                      'table', 'policy', 'status')
 
     id = Column(String(36), primary_key=True)
     proto = Column(String(30), server_default="")
@@ -560,6 +616,7 @@ class Policy(Base):
 class DatacenterPolicy(Policy):
 
     __mapper_args__ = {'polymorphic_identity': 'datacenter'}
+    load_options = {'full': (joinedload('datacenter'),)}
 
     datacenter = relationship('Datacenter', foreign_keys=Policy.owner_id, primaryjoin=Policy.owner_id == Datacenter.id)
 
@@ -583,6 +640,7 @@ class DatacenterPolicy(Policy):
 class ZonePolicy(Policy):
 
     __mapper_args__ = {'polymorphic_identity': 'zone'}
+    load_options = {'full': (joinedload('zone'),)}
 
     zone = relationship('Zone', foreign_keys=Policy.owner_id, primaryjoin=Policy.owner_id == Zone.id)
 
@@ -606,6 +664,7 @@ class ZonePolicy(Policy):
 class VlanPolicy(Policy):
 
     __mapper_args__ = {'polymorphic_identity': 'vlan'}
+    load_options = {'full': (joinedload('vlan'),)}
 
     vlan = relationship('Vlan', foreign_keys=Policy.owner_id, primaryjoin=Policy.owner_id == Vlan.id)
 
@@ -629,6 +688,7 @@ class VlanPolicy(Policy):
 class AnycastPolicy(Policy):
 
     __mapper_args__ = {'polymorphic_identity': 'anycast'}
+    load_options = {'full': (joinedload('anycast'),)}
 
     anycast = relationship('Anycast', foreign_keys=Policy.owner_id, primaryjoin=Policy.owner_id == Anycast.id)
 
@@ -652,6 +712,7 @@ class AnycastPolicy(Policy):
 class SubnetPolicy(Policy):
 
     __mapper_args__ = {'polymorphic_identity': 'subnet'}
+    load_options = {'full': (joinedload('subnet'),)}
 
     subnet = relationship('Subnet', foreign_keys=Policy.owner_id, primaryjoin=Policy.owner_id == Subnet.id)
 
@@ -675,6 +736,7 @@ class SubnetPolicy(Policy):
 class AnycastipPolicy(Policy):
 
     __mapper_args__ = {'polymorphic_identity': 'anycastip'}
+    load_options = {'full': (joinedload('ip'),)}
 
     ip = relationship('Anycastip', foreign_keys=Policy.owner_id, primaryjoin=Policy.owner_id == Anycastip.id)
 
@@ -698,6 +760,7 @@ class AnycastipPolicy(Policy):
 class IpPolicy(Policy):
 
     __mapper_args__ = {'polymorphic_identity': 'ip'}
+    load_options = {'full': (joinedload('ip'),)}
 
     ip = relationship('Ip', foreign_keys=Policy.owner_id, primaryjoin=Policy.owner_id == Ip.id)
 
@@ -720,27 +783,158 @@ class IpPolicy(Policy):
                  'owner': self.ip.ip }
 
 
+class ZoneVersion(Base):
+
+    __tablename__ = 'zone_versions'
+
+    zone_id = Column(String(36), primary_key=True)
+    version = Column(Integer(), nullable=False)
+
+    def __init__(self, zone_id, version=1):
+        self.zone_id = zone_id
+        self.version = version
+
+    def __repr__(self):
+       return "<ZoneVersion('%s','%s')>" % (self.zone_id, self.version)
+
+
+class PrefixVersion(Base):
+
+    __tablename__ = 'prefix_versions'
+
+    # Name of the prefix index, subnets or anycasts, bumped along with any
+    # write to its cidrs, see lpm
+    name = Column(String(30), primary_key=True)
+    version = Column(Integer(), nullable=False)
+
+    def __init__(self, name, version=1):
+        self.name = name
+        self.version = version
+
+    def __repr__(self):
+       return "<PrefixVersion('%s','%s')>" % (self.name, self.version)
+
+
+class Ruleset(Base):
+
+    __tablename__ = 'rulesets'
+
+    zone_id = Column(String(36), primary_key=True)
+    firewall_id = Column(String(36), primary_key=True)
+    version = Column(Integer(), nullable=False)
+    payload = Column(Text(4294967295))
+
+    def __init__(self, zone_id, firewall_id, version, payload):
+        self.zone_id = zone_id
+        self.firewall_id = firewall_id
+        self.version = version
+        self.payload = payload
+
+    def __repr__(self):
+       return "<Ruleset('%s','%s','%s')>" % (self.zone_id, self.firewall_id, self.version)
+
+
+class FirewallState(Base):
+
+    __tablename__ = 'firewall_states'
+
+    firewall_id = Column(String(36), primary_key=True)
+    # Last version of the ruleset sent to the firewall, and the last one
+    # its agent acknowledged applying, 0 when it never did
+    version = Column(Integer(), nullable=False)
+    acked = Column(Integer(), nullable=False)
+    # Version -> fingerprint of the ruleset sent under it, for acked and
+    # the versions after it, see firewall._fingerprint_
+    sent = Column(Text(4294967295))
+
+    def __init__(self, firewall_id):
+        self.firewall_id = firewall_id
+        self.version = 0
+        self.acked = 0
+
+    def __repr__(self):
+       return "<FirewallState('%s','%s','%s')>" % (self.firewall_id, self.version, self.acked)
+
+
+class OutboxEvent(Base):
+
+    __tablename__ = 'event_outbox'
+
+    id = Column(Integer(), primary_key=True, autoincrement=True)
+    routing_key = Column(String(255), nullable=False)
+    method = Column(String(30), nullable=False)
+    payload = Column(Text(4294967295))
+    attempts = Column(Integer(), nullable=False)
+    retry_at = Column(Integer(), nullable=False)
+    # Set while a dispatcher publishes the event, see outbox.dispatch
+    claimed_until = Column(Integer(), nullable=False)
+
+    def __init__(self, routing_key, method, payload):
+        self.routing_key = routing_key
+        self.method = method
+        self.payload = payload
+        self.attempts = 0
+        self.retry_at = 0
+        self.claimed_until = 0
+
+    def __repr__(self):
+       return "<OutboxEvent('%s','%s','%s')>" % (self.id, self.routing_key, self.method)
+
+
+def _sync_range_(target, value, oldvalue, initiator):
+    network = IPNetwork(value)
+    target.first = ip_number(network.network)
+    target.last = ip_number(network.broadcast)
+
+def _sync_number_(target, value, oldvalue, initiator):
+    target.number = ip_number(value)
+
+event.listen(Subnet.cidr, 'set', _sync_range_)
+event.listen(Anycast.cidr, 'set', _sync_range_)
+event.listen(Ip.ip, 'set', _sync_number_)
+event.listen(Anycastip.ip, 'set', _sync_number_)
+
+
 database_type = config.get('server', 'database_type')
 database_name = config.get('server', 'database_name')
 
-engine = None
-if 'sqlite' in database_type:
-    def _fk_pragma_on_connect(dbapi_con, con_record):
-        dbapi_con.execute('pragma foreign_keys=ON')
+def _fk_pragma_on_connect(dbapi_con, con_record):
+    dbapi_con.execute('pragma foreign_keys=ON')
+
+def _pool_option_(option, default):
+    if config.has_option('server', option) and config.get('server', option).strip():
+        return config.getint('server', option)
+    return default
+
+def _create_engine_(name, location):
+    """
+    Engine of the database at location, its file for sqlite and its host
+    otherwise, with its pool instrumented under name
+    """
+    if 'sqlite' in database_type:
+        engine = create_engine('%s:///%s' % (database_type, location))
+        event.listen(engine, 'connect', _fk_pragma_on_connect)
+        return pool.instrument(name, engine)
+    return pool.instrument(name, create_engine("%s://%s:%s@%s/%s" % (database_type,
+                           config.get('server', 'database_user'),
+                           config.get('server', 'database_pass'),
+                           location,
+                           database_name),
+                           poolclass=pool.InstrumentedQueuePool,
+                           pool_size=_pool_option_('database_pool_size', 10),
+                           max_overflow=_pool_option_('database_max_overflow', 4),
+                           pool_timeout=_pool_option_('database_pool_timeout', 30),
+                           pool_recycle=_pool_option_('database_pool_recycle', 120)))
 
-    engine = create_engine('%s:///%s' % (database_type, database_name))
-    event.listen(engine, 'connect', _fk_pragma_on_connect)
+if 'sqlite' in database_type:
+    engine = _create_engine_('primary', database_name)
 else:
-    database_user = config.get('server', 'database_user')
-    database_pass = config.get('server', 'database_pass')
-    database_host = config.get('server', 'database_host')
-    engine = create_engine("%s://%s:%s@%s/%s" % (database_type,
-                            database_user,
-                            database_pass,
-                            database_host,
-                            database_name),
-                            pool_size=10,
-                            max_overflow=4,
-                            pool_recycle=120)
+    engine = _create_engine_('primary', config.get('server', 'database_host'))
+
+# Read only copies of the database, see db_utils.replica_engine
+replicas = []
+if config.has_option('server', 'database_replicas'):
+    replicas = [_create_engine_('replica %s' % x.strip(), x.strip()) for x in
+                config.get('server', 'database_replicas').split(',') if x.strip()]
 
 Base.metadata.create_all(engine)
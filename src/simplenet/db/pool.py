@@ -0,0 +1,121 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+# engine name -> PoolStats, for every engine of this process
+stats = {}
+
+
+class PoolStats(object):
+    """Counters of the connection pool of one engine since the process started"""
+
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.in_use = 0
+        self.in_use_max = 0
+        # Seconds spent waiting for a connection, a free one or a new one
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # Seconds between the checkout of a connection and its checkin
+        self.held_total = 0.0
+        self.held_max = 0.0
+        self.started = time.time()
+
+    def waited(self, seconds):
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['checkout_time'] = time.time()
+        self.checkouts += 1
+        self.in_use += 1
+        self.in_use_max = max(self.in_use_max, self.in_use)
+
+    def checkin(self, dbapi_connection, connection_record):
+        self.in_use -= 1
+        # An invalidated connection comes back with its info cleared
+        start = connection_record.info.pop('checkout_time', None)
+        if start is not None:
+            held = time.time() - start
+            self.held_total += held
+            self.held_max = max(self.held_max, held)
+
+    def connect(self, dbapi_connection, connection_record):
+        self.connects += 1
+
+    def to_dict(self):
+        pool = self.engine.pool
+        checkouts = self.checkouts or 1
+        uptime = time.time() - self.started
+        return {
+            'name': self.name,
+            'pool': pool.__class__.__name__,
+            'size': pool.size() if hasattr(pool, 'size') else None,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+            'max_overflow': getattr(pool, '_max_overflow', None),
+            'in_use': self.in_use,
+            'in_use_max': self.in_use_max,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'connects': self.connects,
+            'connects_per_minute': self.connects * 60 / max(uptime, 1),
+            'wait_avg_ms': self.wait_total * 1000 / checkouts,
+            'wait_max_ms': self.wait_max * 1000,
+            'held_avg_ms': self.held_total * 1000 / checkouts,
+            'held_max_ms': self.held_max * 1000,
+        }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool timing how long each checkout waits for a connection"""
+
+    stats = None
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        except TimeoutError:
+            if self.stats:
+                self.stats.timeouts += 1
+            raise
+        finally:
+            if self.stats:
+                self.stats.waited(time.time() - start)
+
+
+def instrument(name, engine):
+    """Starts keeping the PoolStats of engine under name"""
+    pool_stats = stats[name] = PoolStats(name, engine)
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        engine.pool.stats = pool_stats
+    event.listen(engine, 'checkout', pool_stats.checkout)
+    event.listen(engine, 'checkin', pool_stats.checkin)
+    event.listen(engine, 'connect', pool_stats.connect)
+    return engine
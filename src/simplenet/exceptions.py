@@ -68,3 +68,11 @@ class DuplicatedEntryError(SimpleNetError):
         simplenet_error.__init__(
             403, "%s:%s Duplicated" % (forbidden_type, forbidden_id)
         )
+
+
+class InvalidParameter(SimpleNetError):
+    def __init__(self, param, value):
+        simplenet_error = super(InvalidParameter, self)
+        simplenet_error.__init__(
+            400, "%s:%s Invalid" % (param, value)
+        )
@@ -16,28 +16,53 @@
 # @author: Juliano Martinez (ncode), Locaweb.
 # @author: Luiz Ozaki, Locaweb.
 
-from uuid import UUID
+import base64
+import json
+
+from uuid import UUID, uuid4
+from ipaddr import IPAddress, IPNetwork
 from simplenet.common.config import get_logger
 from simplenet.common.hooks import post_run
 from simplenet.db.models import (
-        new_model, Prober, Datacenter, Zone, Interface,
-        Vlan, Subnet, Anycast, Ip, Anycastip
+        new_model, ip_number, Prober, Datacenter, Zone, Interface,
+        Vlan, Subnet, Anycast, Ip, Anycastip,
+        Firewall, Anycasts_to_Firewall, ZoneVersion, PrefixVersion
 )
-from simplenet.common import event
-from simplenet.db import db_utils
+from simplenet.common import ipam, lpm, outbox
+from simplenet.db import db_utils, pool
 from simplenet.exceptions import (
     FeatureNotAvailable, EntityNotFound,
     OperationNotPermited, DuplicatedEntryError,
-    OperationFailed
+    OperationFailed, InvalidParameter
 )
+from sqlalchemy import and_, or_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, subqueryload
+
+# Maximum number of ips accepted by ip_create_bulk and ip_allocate
+BULK_LIMIT = 65536
+# Times ip_allocate retries when another process took the chosen addresses
+ALLOCATE_RETRIES = 5
+# Rows fetched and converted at a time by streamed list routes
+STREAM_BATCH = 500
+
+# (model, relationship to its parent) from the leaf up to the datacenter
+HIERARCHY = [
+    (Ip, 'subnet'),
+    (Subnet, 'vlan'),
+    (Vlan, 'zone'),
+    (Zone, 'datacenter'),
+    (Datacenter, None),
+]
 
 
 class SimpleNet(object):
 
-    def __init__(self):
+    def __init__(self, session=None):
         self.logger = get_logger()
-        self.session = db_utils.get_database_session()
+        # Routes hand in the session of the request, see create_manager
+        self.session = session or db_utils.get_database_session()
+        self.events = outbox.EventOutbox(self.session)
 
     @staticmethod
     def retrieve_valid_uuid(data, _func, field):
@@ -52,15 +77,90 @@ class SimpleNet(object):
 
         return data
 
-    def _generic_list_(self, model_name):
+    def _after_cursor_(self, model, cursor):
+        """Rows whose primary key sorts after the one encoded in cursor"""
+        keys = model.__mapper__.primary_key
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            assert type(values) is list and len(values) == len(keys)
+        except Exception:
+            raise InvalidParameter('cursor', cursor)
+        clause = keys[-1] > values[-1]
+        for key, value in reversed(zip(keys[:-1], values[:-1])):
+            clause = or_(key > value, and_(key == value, clause))
+        return clause
+
+    def _projection_(self, model, query, fields=None, view=None, keys=()):
+        """
+        Narrows query down to fields and returns it with the function turning
+        its rows into the dicts handed out. When all fields are summary_fields
+        of model a column-only select, followed by keys, is enough and no
+        object gets built. Otherwise rows are objects rendered by to_dict,
+        loaded along with the load_options of the view.
+        """
+        if view == 'summary' and not fields:
+            fields = getattr(model, 'summary_fields', ())
+        if fields and set(fields) <= set(getattr(model, 'summary_fields', ())):
+            query = query.with_entities(*([getattr(model, x) for x in fields] + list(keys)))
+            return query, lambda x: dict(zip(fields, x))
+
+        options = getattr(model, 'load_options', {})
+        query = query.options(*options.get(view or 'full', ()))
+        if not fields:
+            return query, lambda x: x.to_dict()
+
+        def render(x):
+            data = x.to_dict()
+            try:
+                return dict((field, data[field]) for field in fields)
+            except KeyError, e:
+                raise InvalidParameter('fields', e.args[0])
+        return query, render
+
+    def _generic_page_(self, model, query, limit, cursor=None, fields=None, view=None):
+        """
+        Keyset page of query: rows come ordered by primary key and the
+        cursor holds the key of the last row handed out, so fetching any
+        page costs the same whatever its position in the table.
+        """
+        keys = model.__mapper__.primary_key
+        query = query.order_by(*keys)
+        if cursor:
+            query = query.filter(self._after_cursor_(model, cursor))
+        query, render = self._projection_(model, query, fields, view, keys)
+        ss = query.limit(limit + 1).all()
+        next_cursor = None
+        if len(ss) > limit:
+            ss = ss[:limit]
+            if isinstance(ss[-1], model):
+                last = model.__mapper__.primary_key_from_instance(ss[-1])
+            else:
+                last = ss[-1][-len(keys):]
+            next_cursor = base64.urlsafe_b64encode(json.dumps(list(last)))
+        return {
+            'items': [render(x) for x in ss],
+            'next_cursor': next_cursor,
+        }
+
+    def _generic_stream_(self, model, query, fields=None, view=None):
+        """Converts the rows of query as they are fetched, STREAM_BATCH at a time"""
+        query, render = self._projection_(model, query, fields, view)
+        for _value in query.yield_per(STREAM_BATCH):
+            yield render(_value)
+
+    def _generic_rows_(self, model, query, limit=None, cursor=None, stream=False,
+                       fields=None, view=None):
+        if limit:
+            return self._generic_page_(model, query, limit, cursor, fields, view)
+        if stream:
+            return self._generic_stream_(model, query, fields, view)
+        query, render = self._projection_(model, query, fields, view)
+        return [render(x) for x in query]
+
+    def _generic_list_(self, model_name, **kwargs):
         model, name = new_model(model_name)
         self.logger.debug("Listing %s" % name)
-        ss = self.session.query(model).all()
-        _values = []
-        for _value in ss:
-            _values.append(
-                _value.to_dict(),
-            )
+        _values = self._generic_rows_(model, self.session.query(model), **kwargs)
         self.logger.debug("Received %s: %s" % (name, _values))
         return _values
 
@@ -80,49 +180,66 @@ class SimpleNet(object):
         self.logger.debug("Successful deletion of %s from %s" % (value, name))
         return True
 
-    def _generic_info_(self, model_name, value):
+    def _generic_info_(self, model_name, value, fields=None, view=None):
         model, name = new_model(model_name)
         self.logger.debug("Getting %s info by %s" % (name, value))
-        ss = self.session.query(model).filter_by(**value).first()
+        query, render = self._projection_(
+            model, self.session.query(model).filter_by(**value), fields, view
+        )
+        ss = query.first()
         if not ss:
             raise EntityNotFound(name, value)
-        data = ss.to_dict()
+        data = render(ss)
         self.logger.debug("Received %s from [%s]" % (data, value))
         return data
 
-    def _generic_list_by_something_(self, model_name, value):
+    def _generic_list_by_something_(self, model_name, value, **kwargs):
         model, name = new_model(model_name)
         self.logger.debug("Getting %s by %s" % (name, value))
-        ss = self.session.query(model).filter_by(**value).all()
-        _values = []
-        for _value in ss:
-            _values.append(
-                _value.to_dict()
-            )
+        _values = self._generic_rows_(
+            model, self.session.query(model).filter_by(**value), **kwargs
+        )
         self.logger.debug("Received %s: %s from [%s]" % (name, _values, value))
         return _values
 
+    def _get_lineage_(self, model_name, id):
+        model, name = new_model(model_name)
+        self.logger.debug("Getting %s lineage by %s" % (name, id))
+        models = [x[0] for x in HIERARCHY]
+        lineage = HIERARCHY[models.index(model):]
+        query = self.session.query(*[x[0] for x in lineage])
+        for _model, parent in lineage[:-1]:
+            query = query.join(getattr(_model, parent))
+        ss = query.filter(model.id == id).first()
+        if not ss:
+            raise EntityNotFound(name, {'id': id})
+        return ss
+
+    def _load_subnets_(self, *criterion):
+        # The ips collection and the interface behind each ip are eager loaded,
+        # everything else Subnet.to_dict touches is already in the identity map
+        return self.session.query(Subnet).filter(*criterion).options(
+            subqueryload(Subnet.ip),
+            joinedload('ip.interface'),
+        ).all()
+
     def _get_data_ip_(self, id):
         self.logger.debug("Getting ip data %s" % id)
-        ip = self.ip_info(id)
-        subnet = self.subnet_info(ip['subnet_id'])
-        vlan = self.vlan_info(subnet['vlan_id'])
-        zone = self.zone_info(vlan['zone_id'])
-        datacenter = self.datacenter_info(zone['datacenter_id'])
+        ip, subnet, vlan, zone, datacenter = self._get_lineage_("Ip", id)
         self.logger.debug("Received ip: %s vlan: %s zone: %s "
             "datacenter: %s from [%s]" %
             (ip, vlan, zone, datacenter, id)
         )
         return {
-            'ip': ip['ip'],
-            'subnet': subnet['cidr'],
-            'subnet_id': subnet['id'],
-            'vlan': vlan['name'],
-            'vlan_id': vlan['id'],
-            'zone': zone['name'],
-            'zone_id': zone['id'],
-            'datacenter': datacenter['name'],
-            'datacenter_id': datacenter['id'],
+            'ip': ip.ip,
+            'subnet': subnet.cidr,
+            'subnet_id': subnet.id,
+            'vlan': vlan.name,
+            'vlan_id': vlan.id,
+            'zone': zone.name,
+            'zone_id': zone.id,
+            'datacenter': datacenter.name,
+            'datacenter_id': datacenter.id,
         }
 
     def _get_data_anycastip_(self, id):
@@ -140,23 +257,21 @@ class SimpleNet(object):
 
     def _get_data_subnet_(self, id):
         self.logger.debug("Getting subnet data %s" % id)
-        subnet = self.subnet_info(id)
-        vlan = self.vlan_info(subnet['vlan_id'])
-        zone = self.zone_info(vlan['zone_id'])
-        datacenter = self.datacenter_info(zone['datacenter_id'])
+        subnet, vlan, zone, datacenter = self._get_lineage_("Subnet", id)
+        ips = self._load_subnets_(Subnet.id == id)[0].ip
         self.logger.debug("Received subnet: %s vlan: %s "
             "zone: %s datacenter: %s from [%s]" %
             (subnet, vlan, zone, datacenter, id)
         )
         return {
-            'subnet': subnet['cidr'],
-            'vlan': vlan['name'],
-            'vlan_id': vlan['id'],
-            'zone': zone['name'],
-            'zone_id': zone['id'],
-            'datacenter': datacenter['name'],
-            'datacenter_id': datacenter['id'],
-            'ips': self.ip_list_by_subnet(id)
+            'subnet': subnet.cidr,
+            'vlan': vlan.name,
+            'vlan_id': vlan.id,
+            'zone': zone.name,
+            'zone_id': zone.id,
+            'datacenter': datacenter.name,
+            'datacenter_id': datacenter.id,
+            'ips': [x.to_dict() for x in ips],
         }
 
     def _get_data_anycast_(self, id):
@@ -171,39 +286,53 @@ class SimpleNet(object):
             'anycastips': self.anycastip_list_by_anycast(id)
         }
 
+    def _vlan_tree_(self, vlan, zone, datacenter, subnets):
+        return {
+            'vlan': vlan.name,
+            'vlan_id': vlan.id,
+            'zone': zone.name,
+            'zone_id': zone.id,
+            'datacenter': datacenter.name,
+            'datacenter_id': datacenter.id,
+            'subnets': [x.to_dict() for x in subnets],
+        }
+
     def _get_data_vlan_(self, id):
         self.logger.debug("Getting vlan data %s" % id)
-        vlan = self.vlan_info(id)
-        zone = self.zone_info(vlan['zone_id'])
-        datacenter = self.datacenter_info(zone['datacenter_id'])
+        vlan, zone, datacenter = self._get_lineage_("Vlan", id)
+        subnets = self._load_subnets_(Subnet.vlan_id == id)
         self.logger.debug("Received vlan: %s zone: %s "
             "datacenter: %s from [%s]" % (vlan, zone, datacenter, id)
         )
+        return self._vlan_tree_(vlan, zone, datacenter, subnets)
+
+    def _load_zone_(self, id):
+        zone, datacenter = self._get_lineage_("Zone", id)
+        vlans = self.session.query(Vlan).filter_by(zone_id=id).all()
+        subnets = {}
+        for subnet in self._load_subnets_(Subnet.vlan_id.in_(
+                self.session.query(Vlan.id).filter_by(zone_id=id))):
+            subnets.setdefault(subnet.vlan_id, []).append(subnet)
+        return zone, datacenter, vlans, subnets
+
+    def _zone_tree_(self, zone, datacenter, vlans, subnets):
         return {
-            'vlan': vlan['name'],
-            'vlan_id': vlan['id'],
-            'zone': zone['name'],
-            'zone_id': zone['id'],
-            'datacenter': datacenter['name'],
-            'datacenter_id': datacenter['id'],
-            'subnets': self.subnet_list_by_vlan(id),
+            'zone': zone.name,
+            'zone_id': zone.id,
+            'datacenter': datacenter.name,
+            'datacenter_id': datacenter.id,
+            'vlans': [ self._vlan_tree_(vlan, zone, datacenter,
+                                        subnets.get(vlan.id, []))
+                       for vlan in vlans ]
         }
 
     def _get_data_zone_(self, id):
         self.logger.debug("Getting zone data %s" % id)
-        zone = self.zone_info(id)
-        datacenter = self.datacenter_info(zone['datacenter_id'])
+        zone, datacenter, vlans, subnets = self._load_zone_(id)
         self.logger.debug("Received zone: %s datacenter: %s from [%s]" %
             (zone, datacenter, id)
         )
-        return {
-            'zone': zone['name'],
-            'zone_id': zone['id'],
-            'datacenter': datacenter['name'],
-            'datacenter_id': datacenter['id'],
-            'vlans': [ self._get_data_vlan_(vlan['id'])
-                       for vlan in self.vlan_list_by_zone(id) ]
-        }
+        return self._zone_tree_(zone, datacenter, vlans, subnets)
 
     def _get_data_datacenter_(self, id):
         self.logger.debug("Getting datacenter data %s" % id)
@@ -216,24 +345,82 @@ class SimpleNet(object):
             'zones': self.zone_list_by_datacenter(id),
         }
 
+    def _zones_of_(self, owner_type, owner_id):
+        """Ids of the zones whose firewall ruleset includes the given owner"""
+        if owner_type == 'zone':
+            return [owner_id]
+        elif owner_type in ('vlan', 'subnet', 'ip'):
+            model, _ = new_model(owner_type.capitalize())
+            query = self.session.query(Vlan.zone_id)
+            lineage = [x[0] for x in HIERARCHY]
+            for _model in reversed(lineage[lineage.index(model):lineage.index(Vlan)]):
+                query = query.join(_model)
+            ss = query.filter(model.id == owner_id).all()
+        elif owner_type in ('anycast', 'anycastip'):
+            query = self.session.query(Firewall.zone_id).join(Anycasts_to_Firewall)
+            if owner_type == 'anycast':
+                ss = query.filter(Anycasts_to_Firewall.anycast_id == owner_id).all()
+            else:
+                ss = query.join(Anycastip,
+                    Anycastip.anycast_id == Anycasts_to_Firewall.anycast_id
+                ).filter(Anycastip.id == owner_id).all()
+        else:
+            ss = []
+        return [x[0] for x in ss]
+
+    def _zone_version_(self, zone_id):
+        ss = self.session.query(ZoneVersion.version).filter_by(zone_id=zone_id).first()
+        return ss[0] if ss else 0
+
+    def _bump_zones_(self, zone_ids):
+        """Invalidates the compiled rulesets of the given zones"""
+        zone_ids = set(zone_ids)
+        if not zone_ids:
+            return
+        self.logger.debug("Bumping version of zones %s" % zone_ids)
+        for attempt in range(2):
+            self.session.begin(subtransactions=True)
+            try:
+                criterion = ZoneVersion.zone_id.in_(zone_ids)
+                bumped = [x[0] for x in
+                          self.session.query(ZoneVersion.zone_id).filter(criterion)]
+                self.session.query(ZoneVersion).filter(criterion).update({ZoneVersion.version: ZoneVersion.version + 1},
+                             synchronize_session=False)
+                for zone_id in zone_ids.difference(bumped):
+                    self.session.add(ZoneVersion(zone_id=zone_id))
+                self.session.commit()
+                return
+            except IntegrityError:
+                # A concurrent bump created the row, the update covers it now
+                self.session.rollback()
+            except Exception, e:
+                self.session.rollback()
+                raise Exception(e)
+
+    def _touch_zones_(self, owner_type, owner_id):
+        self._bump_zones_(self._zones_of_(owner_type, owner_id))
+
     def prober(self):
         self.logger.debug("Getting prober data")
         ss = self.session.query(Prober).all()
         self.logger.debug("Received prober: %s" % ss)
         return ss
 
-    def firewall_list_by_zone(self, zone_id):
+    def pool_stats(self):
+        return [pool.stats[x].to_dict() for x in sorted(pool.stats)]
+
+    def firewall_list_by_zone(self, zone_id, **kwargs):
         return self._generic_list_by_something_(
-            "Firewall", {'zone_id': zone_id}
+            "Firewall", {'zone_id': zone_id}, **kwargs
         )
 
-    def router_list_by_zone(self, zone_id):
+    def router_list_by_zone(self, zone_id, **kwargs):
         return self._generic_list_by_something_(
-            "Router", {'zone_id': zone_id}
+            "Router", {'zone_id': zone_id}, **kwargs
         )
 
-    def datacenter_list(self):
-        return self._generic_list_("Datacenter")
+    def datacenter_list(self, **kwargs):
+        return self._generic_list_("Datacenter", **kwargs)
 
     def datacenter_create(self, data):
         self.logger.debug("Creating datacenter using data: %s" % data)
@@ -257,24 +444,24 @@ class SimpleNet(object):
     def datacenter_update(self, *args, **kawrgs):
         raise FeatureNotAvailable()
 
-    def datacenter_info(self, id):
-        return self._generic_info_("Datacenter", {'id': id})
+    def datacenter_info(self, id, **kwargs):
+        return self._generic_info_("Datacenter", {'id': id}, **kwargs)
 
-    def datacenter_info_by_name(self, name):
+    def datacenter_info_by_name(self, name, **kwargs):
         return self._generic_info_(
-            "Datacenter", {'name': name}
+            "Datacenter", {'name': name}, **kwargs
         )
 
     def datacenter_delete(self, id):
         return self._generic_delete_("Datacenter", {'id': id})
 
-    def zone_list(self):
-        return self._generic_list_("Zone")
+    def zone_list(self, **kwargs):
+        return self._generic_list_("Zone", **kwargs)
 
-    def zone_list_by_datacenter(self, datacenter_id):
+    def zone_list_by_datacenter(self, datacenter_id, **kwargs):
         return self._generic_list_by_something_(
             "Zone",
-            {'datacenter_id': datacenter_id}
+            {'datacenter_id': datacenter_id}, **kwargs
         )
 
     def zone_create(self, datacenter_id, data):
@@ -308,35 +495,35 @@ class SimpleNet(object):
     def zone_update(self, *args, **kawrgs):
         raise FeatureNotAvailable()
 
-    def zone_info(self, id):
-        return self._generic_info_("Zone", {'id': id})
+    def zone_info(self, id, **kwargs):
+        return self._generic_info_("Zone", {'id': id}, **kwargs)
 
-    def zone_info_by_name(self, name):
+    def zone_info_by_name(self, name, **kwargs):
         return self._generic_info_(
-            "Zone", {'name': name}
+            "Zone", {'name': name}, **kwargs
         )
 
     def zone_delete(self, id):
         return self._generic_delete_("Zone", {'id': id})
 
-    def vlan_list(self):
-        return self._generic_list_("Vlan")
+    def vlan_list(self, **kwargs):
+        return self._generic_list_("Vlan", **kwargs)
 
-    def vlan_list_by_firewall(self, firewall_id):
+    def vlan_list_by_firewall(self, firewall_id, **kwargs):
         return self._generic_list_by_something_(
             "Vlans_to_Firewall",
-            {'firewall_id': firewall_id}
+            {'firewall_id': firewall_id}, **kwargs
         )
 
-    def vlan_list_by_dhcp(self, dhcp_id):
+    def vlan_list_by_dhcp(self, dhcp_id, **kwargs):
         return self._generic_list_by_something_(
             "Vlans_to_Dhcp",
-            {'dhcp_id': dhcp_id}
+            {'dhcp_id': dhcp_id}, **kwargs
         )
 
-    def vlan_list_by_zone(self, zone_id):
+    def vlan_list_by_zone(self, zone_id, **kwargs):
         return self._generic_list_by_something_(
-            "Vlan", {'zone_id': zone_id}
+            "Vlan", {'zone_id': zone_id}, **kwargs
         )
 
     def vlan_create(self, zone_id, data):
@@ -364,38 +551,42 @@ class SimpleNet(object):
         self.logger.debug("Created vlan on zone: %s using data: %s" %
             (zone_id, data)
         )
+        self._bump_zones_([zone_id])
         return self.vlan_info_by_name(data['name'])
 
-    def vlan_info(self, id):
-        return self._generic_info_("Vlan", {'id': id})
+    def vlan_info(self, id, **kwargs):
+        return self._generic_info_("Vlan", {'id': id}, **kwargs)
 
-    def vlan_info_by_name(self, name):
+    def vlan_info_by_name(self, name, **kwargs):
         return self._generic_info_(
-            "Vlan", {'name': name}
+            "Vlan", {'name': name}, **kwargs
         )
 
     def vlan_update(self, *args, **kawrgs):
         raise FeatureNotAvailable()
 
     def vlan_delete(self, id):
-        return self._generic_delete_("Vlan", {'id': id})
+        zones = self._zones_of_('vlan', id)
+        ret = self._generic_delete_("Vlan", {'id': id})
+        self._bump_zones_(zones)
+        return ret
 
-    def subnet_list(self):
-        return self._generic_list_("Subnet")
+    def subnet_list(self, **kwargs):
+        return self._generic_list_("Subnet", **kwargs)
 
-    def anycast_list(self):
-        return self._generic_list_("Anycast")
+    def anycast_list(self, **kwargs):
+        return self._generic_list_("Anycast", **kwargs)
 
-    def anycast_list_by_firewall(self, firewall_id):
+    def anycast_list_by_firewall(self, firewall_id, **kwargs):
         return self._generic_list_by_something_(
             "Anycasts_to_Firewall",
-            {'firewall_id': firewall_id}
+            {'firewall_id': firewall_id}, **kwargs
         )
 
-    def subnet_list_by_vlan(self, vlan_id):
+    def subnet_list_by_vlan(self, vlan_id, **kwargs):
         return self._generic_list_by_something_(
             "Subnet",
-            {'vlan_id': vlan_id}
+            {'vlan_id': vlan_id}, **kwargs
         )
 
     @post_run
@@ -403,6 +594,7 @@ class SimpleNet(object):
         self.session.begin(subtransactions=True)
         try:
             self.session.add(Subnet(cidr=data['cidr'], vlan_id=vlan_id))
+            version = self._bump_prefixes_(lpm.subnets)
             self.session.commit()
         except IntegrityError, e:
             self.session.rollback()
@@ -419,13 +611,19 @@ class SimpleNet(object):
             raise Exception(e)
         vlan = self.session.query(Vlan).get(vlan_id)
         #self._enqueue_dhcp_entries_(vlan, 'update')
-        return self.subnet_info_by_cidr(data['cidr'])
+        self._touch_zones_('vlan', vlan_id)
+        subnet = self.subnet_info_by_cidr(data['cidr'])
+        self._prefixes_changed_(lpm.subnets, version, lambda: lpm.subnets.add(subnet['cidr'],
+            self._subnet_entry_(subnet['id'], subnet['cidr'], vlan_id, vlan.zone_id)
+        ))
+        return subnet
 
     def anycast_create(self, data):
         self.logger.debug("Creating subnet using data: %s" % data)
         self.session.begin(subtransactions=True)
         try:
             self.session.add(Anycast(cidr=data['cidr']))
+            version = self._bump_prefixes_(lpm.anycasts)
             self.session.commit()
         except IntegrityError, e:
             self.session.rollback()
@@ -439,24 +637,151 @@ class SimpleNet(object):
             self.session.rollback()
             raise Exception(e)
         self.logger.debug("Created subnet using data: %s" % data)
-        return self.anycast_info_by_cidr(data['cidr'])
+        anycast = self.anycast_info_by_cidr(data['cidr'])
+        self._prefixes_changed_(lpm.anycasts, version, lambda: lpm.anycasts.add(anycast['cidr'],
+            self._anycast_entry_(anycast['id'], anycast['cidr'])
+        ))
+        return anycast
 
-    def anycast_info_by_cidr(self, cidr):
+    def anycast_info_by_cidr(self, cidr, **kwargs):
         return self._generic_info_(
-            "Anycast", {'cidr': cidr.replace('_','/')}
+            "Anycast", {'cidr': cidr.replace('_','/')}, **kwargs
         )
 
-    def subnet_info(self, id):
-        return self._generic_info_("Subnet", {'id': id})
+    def subnet_info(self, id, **kwargs):
+        return self._generic_info_("Subnet", {'id': id}, **kwargs)
 
-    def anycast_info(self, id):
-        return self._generic_info_("Anycast", {'id': id})
+    def anycast_info(self, id, **kwargs):
+        return self._generic_info_("Anycast", {'id': id}, **kwargs)
 
-    def subnet_info_by_cidr(self, cidr):
+    def subnet_info_by_cidr(self, cidr, **kwargs):
         return self._generic_info_(
-            "Subnet", {'cidr': cidr.replace('_','/')}
+            "Subnet", {'cidr': cidr.replace('_','/')}, **kwargs
         )
 
+    def _ip_number_(self, model_name, ip):
+        try:
+            return ip_number(ip)
+        except ValueError:
+            raise OperationNotPermited(model_name, "%s is not a valid ip" % ip)
+
+    def _network_range_(self, model_name, cidr):
+        try:
+            network = IPNetwork(cidr.replace('_','/'))
+        except ValueError:
+            raise OperationNotPermited(model_name, "%s is not a valid cidr" % cidr)
+        return ip_number(network.network), ip_number(network.broadcast)
+
+    def _subnet_entry_(self, id, cidr, vlan_id, zone_id):
+        return {'id': id, 'cidr': cidr, 'vlan_id': vlan_id, 'zone_id': zone_id}
+
+    def _anycast_entry_(self, id, cidr):
+        return {'id': id, 'cidr': cidr}
+
+    def _prefix_versions_(self, session=None):
+        session = session or self.session
+        return dict(session.query(PrefixVersion.name, PrefixVersion.version))
+
+    def _bump_prefixes_(self, index):
+        """
+        Bumps the version of the cidrs of index, in the transaction writing
+        them, for every process to reload its copy. Returns the new one.
+        """
+        self.session.flush()
+        bumped = self.session.query(PrefixVersion).filter_by(name=index.name).update(
+            {PrefixVersion.version: PrefixVersion.version + 1}, synchronize_session=False
+        )
+        if not bumped:
+            self.session.add(PrefixVersion(index.name))
+            self.session.flush()
+        return self._prefix_versions_()[index.name]
+
+    def _prefixes_changed_(self, index, version, change):
+        # Applied in place when this process had the version before it,
+        # otherwise it missed others and reloads on the next lookup
+        if index.version == version - 1:
+            change()
+            index.version = version
+
+    def prefix_index_load(self, session=None):
+        """(Re)builds the in-process lpm indexes of subnets and anycasts"""
+        self.logger.debug("Loading subnets and anycasts prefix indexes")
+        session = session or self.session
+        versions = self._prefix_versions_(session)
+        lpm.subnets.clear()
+        for id, cidr, vlan_id, zone_id in session.query(
+                Subnet.id, Subnet.cidr, Subnet.vlan_id, Vlan.zone_id
+            ).outerjoin(Vlan, Subnet.vlan_id == Vlan.id):
+            lpm.subnets.add(cidr, self._subnet_entry_(id, cidr, vlan_id, zone_id))
+        lpm.subnets.checked(versions.get(lpm.subnets.name, 0))
+        lpm.anycasts.clear()
+        for id, cidr in session.query(Anycast.id, Anycast.cidr):
+            lpm.anycasts.add(cidr, self._anycast_entry_(id, cidr))
+        lpm.anycasts.checked(versions.get(lpm.anycasts.name, 0))
+
+    def _prefix_check_(self):
+        """
+        Reloads the prefix indexes when another process wrote their cidrs.
+        Read from the primary, a replica may not have the write yet.
+        """
+        session = db_utils.get_database_session()
+        try:
+            versions = self._prefix_versions_(session)
+            indexes = (lpm.subnets, lpm.anycasts)
+            if any(x.version != versions.get(x.name, 0) for x in indexes):
+                self.prefix_index_load(session)
+            else:
+                [x.checked(x.version) for x in indexes]
+        finally:
+            session.close()
+
+    def _prefix_lookup_(self, index, ip):
+        # Checked with the database every lpm.VERSION_TTL seconds at most,
+        # and on the invalidations of the cidrs broadcast by other processes
+        if index.expired():
+            self._prefix_check_()
+        try:
+            entry = index.lookup(ip)
+        except ValueError:
+            raise OperationNotPermited('Ip', "%s is not a valid ip" % ip)
+        return dict(entry) if entry else None
+
+    def prefix_lookup(self, ip):
+        return {
+            'ip': ip,
+            'subnet': self._prefix_lookup_(lpm.subnets, ip),
+            'anycast': self._prefix_lookup_(lpm.anycasts, ip),
+        }
+
+    def subnet_containing(self, ip):
+        subnet = self._prefix_lookup_(lpm.subnets, ip)
+        # Deleted by another process the index has not heard of yet
+        subnets = subnet and self._load_subnets_(Subnet.id == subnet['id'])
+        if not subnets:
+            raise EntityNotFound('subnets', {'ip': ip})
+        return subnets[0].to_dict()
+
+    def anycast_containing(self, ip):
+        anycast = self._prefix_lookup_(lpm.anycasts, ip)
+        if not anycast:
+            raise EntityNotFound('anycasts', {'ip': ip})
+        return self._generic_info_("Anycast", {'id': anycast['id']})
+
+    def subnet_list_overlapping(self, cidr):
+        first, last = self._network_range_('Subnet', cidr)
+        subnets = self._load_subnets_(Subnet.first <= last, Subnet.last >= first)
+        return [x.to_dict() for x in sorted(subnets, key=lambda x: x.first)]
+
+    def ip_list_in_range(self, first, last):
+        first = self._ip_number_('Ip', first)
+        last = self._ip_number_('Ip', last)
+        ips = self.session.query(Ip).filter(
+            Ip.number >= first, Ip.number <= last
+        ).order_by(Ip.number).options(
+            joinedload(Ip.subnet), joinedload(Ip.interface)
+        ).all()
+        return [x.to_dict() for x in ips]
+
     def subnet_update(self, *args, **kwargs):
         raise FeatureNotAvailable()
 
@@ -464,33 +789,61 @@ class SimpleNet(object):
     def subnet_delete(self, id):
         subnet = self.session.query(Subnet).get(id)
         vlan = subnet.vlan
-        ret = self._generic_delete_("Subnet", {'id': id})
+        cidr = subnet.cidr
+        zones = self._zones_of_('subnet', id)
+        self.session.begin(subtransactions=True)
+        try:
+            ret = self._generic_delete_("Subnet", {'id': id})
+            version = self._bump_prefixes_(lpm.subnets)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
         #self._enqueue_dhcp_entries_(vlan, 'update')
+        ipam.forget(id)
+        self._prefixes_changed_(lpm.subnets, version, lambda: lpm.subnets.remove(cidr))
+        self._bump_zones_(zones)
         return ret
 
     def anycast_delete(self, id):
-        return self._generic_delete_("Anycast", {'id': id})
+        anycast = self.session.query(Anycast).get(id)
+        zones = self._zones_of_('anycast', id)
+        if anycast:
+            cidr = anycast.cidr
+            self.session.begin(subtransactions=True)
+            try:
+                ret = self._generic_delete_("Anycast", {'id': id})
+                version = self._bump_prefixes_(lpm.anycasts)
+                self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
+            self._prefixes_changed_(lpm.anycasts, version, lambda: lpm.anycasts.remove(cidr))
+        else:
+            ret = self._generic_delete_("Anycast", {'id': id})
+        self._bump_zones_(zones)
+        return ret
 
-    def ip_list(self):
-        return self._generic_list_("Ip")
+    def ip_list(self, **kwargs):
+        return self._generic_list_("Ip", **kwargs)
 
-    def ip_list_by_subnet(self, subnet_id):
+    def ip_list_by_subnet(self, subnet_id, **kwargs):
         return self._generic_list_by_something_(
-            "Ip", {'subnet_id': subnet_id}
+            "Ip", {'subnet_id': subnet_id}, **kwargs
         )
 
-    def ip_list_by_id(self, ip_id):
+    def ip_list_by_id(self, ip_id, **kwargs):
         return self._generic_list_by_something_(
-            "Ip", {'id': ip_id}
+            "Ip", {'id': ip_id}, **kwargs
         )
 
-    def anycastip_list_by_anycast(self, anycast_id):
+    def anycastip_list_by_anycast(self, anycast_id, **kwargs):
         return self._generic_list_by_something_(
-            "Anycastip", {'anycast_id': anycast_id}
+            "Anycastip", {'anycast_id': anycast_id}, **kwargs
         )
 
-    def anycastip_list(self):
-        return self._generic_list_("Anycastip")
+    def anycastip_list(self, **kwargs):
+        return self._generic_list_("Anycastip", **kwargs)
 
     def ip_create(self, subnet_id, data):
         self.logger.debug("Creating ip on subnet: %s using data: %s" %
@@ -526,8 +879,129 @@ class SimpleNet(object):
         self.logger.debug("Created ip on subnet: %s using data: %s" %
             (subnet_id, data)
         )
+        ipam.occupy(subnet_id, [data['ip']])
+        self._touch_zones_('subnet', subnet_id)
         return self.ip_info_by_ip(data['ip'])
 
+    def ip_create_bulk(self, subnet_id, data):
+        self.logger.debug("Creating ips on subnet: %s using data: %s" %
+            (subnet_id, data)
+        )
+        subnet = self.session.query(Subnet).get(subnet_id)
+        if not subnet:
+            raise OperationNotPermited('Ip', "subnet_id %s doesnt exist" % subnet_id)
+        network = subnet.to_ip()
+
+        if type(data) == list:
+            data = {'ips': data}
+        try:
+            if data.get('ips') is not None:
+                ips = [(ip, IPAddress(ip)) for ip in data['ips']]
+            else:
+                first, last = IPAddress(data['first']), IPAddress(data['last'])
+                count = int(last) - int(first) + 1
+                if first.version != last.version or not 0 < count <= BULK_LIMIT:
+                    raise ValueError("invalid range %s - %s" % (first, last))
+                ips = [IPAddress(int(first) + i, first.version) for i in xrange(count)]
+                ips = [(str(x), x) for x in ips]
+        except (KeyError, TypeError, ValueError), e:
+            raise OperationNotPermited('Ip', "%s is not a valid input -- %s" % (data, e))
+        if not ips or len(ips) > BULK_LIMIT:
+            raise OperationNotPermited('Ip', "between 1 and %s ips are allowed" % BULK_LIMIT)
+
+        outside = [ip for ip, address in ips if address not in network]
+        if outside:
+            raise OperationNotPermited(
+                'Ip', "%s address must be contained in %s" % (
+                        ", ".join(outside[:10]),
+                        subnet.cidr
+                )
+            )
+
+        try:
+            ips = self._insert_ips_(subnet, [ip for ip, address in ips])
+        except IntegrityError, e:
+            msg = str(e)
+            if msg.find("is not unique") != -1 or msg.find("Duplicate entry") != -1 or msg.find("UNIQUE constraint failed") != -1:
+                raise DuplicatedEntryError('Ip', "one of the ips already exists")
+            raise OperationNotPermited('Ip', "Unknown error")
+        self.logger.debug("Created %s ips on subnet: %s" % (len(ips), subnet_id))
+        return ips
+
+    def _insert_ips_(self, subnet, ips):
+        """Inserts all ips in subnet with a single executemany"""
+        rows = [{'id': str(uuid4()), 'ip': ip, 'number': ip_number(ip),
+                 'subnet_id': subnet.id, 'description': None} for ip in ips]
+        self.session.begin(subtransactions=True)
+        try:
+            self.session.execute(Ip.__table__.insert(), rows)
+            db_utils.written(self.session, ['ips'], parents=[('subnets', subnet.id)])
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        ipam.occupy(subnet.id, ips)
+        self._touch_zones_('subnet', subnet.id)
+        return [{
+            'id': row['id'],
+            'ip': row['ip'],
+            'subnet': subnet.cidr,
+            'subnet_id': subnet.id,
+            'interface_id': None,
+            'hostname': None,
+        } for row in rows]
+
+    def _subnet_bitmap_(self, subnet, rebuild=False):
+        bitmap = ipam.bitmaps.get(subnet.id)
+        if bitmap is None or rebuild:
+            self.logger.debug("Building occupancy bitmap of subnet %s" % subnet.id)
+            bitmap = ipam.SubnetBitmap(subnet.to_ip())
+            bitmap.load(x[0] for x in
+                        self.session.query(Ip.ip).filter_by(subnet_id=subnet.id))
+            ipam.bitmaps[subnet.id] = bitmap
+        return bitmap
+
+    def ip_allocate(self, subnet_id, count=1):
+        self.logger.debug("Allocating %s ips on subnet: %s" % (count, subnet_id))
+        subnet = self.session.query(Subnet).get(subnet_id)
+        if not subnet:
+            raise OperationNotPermited('Ip', "subnet_id %s doesnt exist" % subnet_id)
+        if not 0 < count <= BULK_LIMIT:
+            raise OperationNotPermited('Ip', "between 1 and %s ips are allowed" % BULK_LIMIT)
+
+        bitmap = self._subnet_bitmap_(subnet)
+        for attempt in range(ALLOCATE_RETRIES):
+            offsets = bitmap.reserve(count)
+            if len(offsets) < count:
+                # Deletes by other processes never clear the bits of this one,
+                # check with the table before calling it full
+                [bitmap.clear(x) for x in offsets]
+                bitmap = self._subnet_bitmap_(subnet, rebuild=True)
+                offsets = bitmap.reserve(count)
+            if len(offsets) < count:
+                [bitmap.clear(x) for x in offsets]
+                raise OperationNotPermited('Ip', "subnet %s has less than %s free ips" % (
+                    subnet.cidr, count)
+                )
+            try:
+                ips = self._insert_ips_(subnet, [bitmap.address(x) for x in offsets])
+            except IntegrityError:
+                # Taken by another process, resync with the table and try again
+                [bitmap.clear(x) for x in offsets]
+                bitmap.load(x[0] for x in
+                            self.session.query(Ip.ip).filter_by(subnet_id=subnet_id))
+                continue
+            except Exception:
+                [bitmap.clear(x) for x in offsets]
+                raise
+            self.logger.debug("Allocated %s on subnet: %s" % (
+                [x['ip'] for x in ips], subnet_id)
+            )
+            return ips
+        raise OperationFailed("Could not allocate ips on %s after %s attempts" % (
+            subnet.cidr, ALLOCATE_RETRIES)
+        )
+
     def anycastip_create(self, anycast_id, data):
         self.logger.debug("Creating ip on anycast: %s using data: %s" %
             (anycast_id, data)
@@ -562,28 +1036,34 @@ class SimpleNet(object):
         self.logger.debug("Created ip on anycast: %s using data: %s" %
             (anycast_id, data)
         )
+        self._touch_zones_('anycast', anycast_id)
         return self.anycastip_info_by_ip(data['ip'])
 
-    def ip_info(self, id):
-        return self._generic_info_("Ip", {'id': id})
+    def ip_info(self, id, **kwargs):
+        return self._generic_info_("Ip", {'id': id}, **kwargs)
 
-    def anycastip_info(self, id):
-        return self._generic_info_("Anycastip", {'id': id})
+    def anycastip_info(self, id, **kwargs):
+        return self._generic_info_("Anycastip", {'id': id}, **kwargs)
 
-    def vlan_info_by_ip(self, ip):
+    def vlan_info_by_ip(self, ip, **kwargs):
         query = {'ip': ip}
-        ss = self.session.query(Ip).filter_by(**query).first()
-        if not ss:
+        subnet_id = self.session.query(Ip.subnet_id).filter_by(**query).scalar()
+        if not subnet_id:
             raise EntityNotFound('Ip', query)
+        # The index knows the vlan unless a more specific subnet holds ip
+        subnet = self._prefix_lookup_(lpm.subnets, ip)
+        if subnet and subnet['id'] == subnet_id:
+            vlan_id = subnet['vlan_id']
+        else:
+            vlan_id = self.session.query(Subnet.vlan_id).filter_by(id=subnet_id).scalar()
+        return self.vlan_info(vlan_id, **kwargs)
 
-        return ss.subnet.vlan.to_dict()
-
-    def ip_info_by_ip(self, ip):
-        return self._generic_info_("Ip", {'ip': ip})
+    def ip_info_by_ip(self, ip, **kwargs):
+        return self._generic_info_("Ip", {'ip': ip}, **kwargs)
 
-    def anycastip_info_by_ip(self, ip):
+    def anycastip_info_by_ip(self, ip, **kwargs):
         return self._generic_info_(
-            "Anycastip", {'ip': ip}
+            "Anycastip", {'ip': ip}, **kwargs
         )
 
     def ip_update(self, *args, **kawrgs):
@@ -592,7 +1072,7 @@ class SimpleNet(object):
     def ip_delete(self, id):
         import simplenet.network_appliances.firewall
         try:
-            pol = simplenet.network_appliances.firewall.Net()
+            pol = simplenet.network_appliances.firewall.Net(self.session)
             pol.policy_delete_by_owner("ip", id)
             ip = self.ip_info(id)
             if ip['interface_id'] is not None:
@@ -600,11 +1080,17 @@ class SimpleNet(object):
         except:
             self.logger.exception("Failed to delete IP")
             raise
+        zones = self._zones_of_('ip', id)
         val = self._generic_delete_("Ip", {'id': id})
+        ipam.release(ip['subnet_id'], [ip['ip']])
+        self._bump_zones_(zones)
         return val
 
     def anycastip_delete(self, id):
-        return self._generic_delete_("Anycastip", {'id': id})
+        zones = self._zones_of_('anycastip', id)
+        ret = self._generic_delete_("Anycastip", {'id': id})
+        self._bump_zones_(zones)
+        return ret
 
     def policy_list(self, *args, **kawrgs):
         raise FeatureNotAvailable()
@@ -621,8 +1107,8 @@ class SimpleNet(object):
     def policy_delete(self, *args, **kawrgs):
         raise FeatureNotAvailable()
 
-    def interface_list(self):
-        return self._generic_list_("Interface")
+    def interface_list(self, **kwargs):
+        return self._generic_list_("Interface", **kwargs)
 
     def interface_create(self, data):
         self.logger.debug("Creating interface using data: %s" % data)
@@ -648,11 +1134,11 @@ class SimpleNet(object):
     def interface_delete(self, data):
         return self._generic_delete_("Interface", {'id': data})
 
-    def interface_info(self, mac):
-        return self.interface_info_by_mac(mac)
+    def interface_info(self, mac, **kwargs):
+        return self.interface_info_by_mac(mac, **kwargs)
 
-    def interface_info_by_mac(self, mac):
-        return self._generic_info_("Interface", {'id': mac})
+    def interface_info_by_mac(self, mac, **kwargs):
+        return self._generic_info_("Interface", {'id': mac}, **kwargs)
 
     def interface_add_vlan(self, interface_id, data):
         self.logger.debug("Adding VLAN to interface using data: %s" % data)
@@ -723,27 +1209,31 @@ class SimpleNet(object):
         if not ip:
             raise EntityNotFound('Ip', data)
 
+        ip_id = ip.id
         self.session.begin(subtransactions=True)
         try:
             interface.ips.add(ip)
+            self.session.flush()
+
+            _data = interface.tree_dict()
+            _data['action'] = "replug"
+            zones = set()
+            for ip in _data['ips']:
+                zones.add(ip['subnet']['vlan']['zone_id'])
+
+            _data['firewalls'] = []
+            for zone in zones:
+                for fw in self.firewall_list_by_zone(zone):
+                    _data['firewalls'].append(fw) if fw.get("mac") is not None else None
+
+            if (_data.get("switch_id")):
+                # Stored in the outbox by the same transaction
+                self.events.raise_event(_data['switch_id']['name'].split(":")[0], _data)
             self.session.commit()
         except Exception, e:
             self.session.rollback()
             raise Exception(e)
-
-        _data = interface.tree_dict()
-        _data['action'] = "replug"
-        zones = set()
-        for ip in _data['ips']:
-            zones.add(ip['subnet']['vlan']['zone_id'])
-
-        _data['firewalls'] = []
-        for zone in zones:
-            for fw in self.firewall_list_by_zone(zone):
-                _data['firewalls'].append(fw) if fw.get("mac") is not None else None
-
-        if (_data.get("switch_id")):
-            event.EventManager().raise_event(_data['switch_id']['name'].split(":")[0], _data)
+        self._touch_zones_('ip', ip_id)
 
         self.logger.debug("Successful adding IP to interface status: %s" % _data)
         return _data
@@ -764,18 +1254,21 @@ class SimpleNet(object):
             self.session.begin(subtransactions=True)
             try:
                 interface.ips.remove(ip)
+                self.session.flush()
+                _data = interface.tree_dict()
+                if (_data.get("switch_id")):
+                    event_data = ip.to_dict()
+                    event_data['action'] = "removeip"
+                    event_data['name'] = _data['name']
+                    event_data['id'] = _data['id']
+                    event_data['switch_id'] = _data['switch_id']
+                    # Stored in the outbox by the same transaction
+                    self.events.raise_event(_data['switch_id']['name'].split(":")[0], event_data)
                 self.session.commit()
             except Exception, e:
                 self.session.rollback()
                 raise Exception(e)
-            _data = interface.tree_dict()
-            if (_data.get("switch_id")):
-                event_data = ip.to_dict()
-                event_data['action'] = "removeip"
-                event_data['name'] = _data['name']
-                event_data['id'] = _data['id']
-                event_data['switch_id'] = _data['switch_id']
-                event.EventManager().raise_event(_data['switch_id']['name'].split(":")[0], event_data)
+            self._touch_zones_('ip', ip_id)
             self.logger.debug("Successful removing IP to interface status: %s" % _data)
         else:
             _data = interface.to_dict()
@@ -16,7 +16,6 @@
 # @author: Juliano Martinez (ncode), Locaweb.
 # @author: Luiz Ozaki, Locaweb.
 
-from simplenet.common import event
 from simplenet.db.models import Dhcp, Vlan, Vlans_to_Dhcp
 from simplenet.exceptions import (
     FeatureNotAvailable, OperationNotPermited, DuplicatedEntryError
@@ -53,8 +52,8 @@ class Net(SimpleNet):
 
         return self.dhcp_info_by_name(data['name'])
 
-    def dhcp_list(self):
-        return self._generic_list_("Dhcp")
+    def dhcp_list(self, **kwargs):
+        return self._generic_list_("Dhcp", **kwargs)
 
     def dhcp_rebuild_queues(self, vlan_id):
         self.logger.debug("Rebuilding queue for %s" %
@@ -77,21 +76,25 @@ class Net(SimpleNet):
             relationship = Vlans_to_Dhcp()
             relationship.vlan = vlan
             dhcp.vlans_to_dhcps.append(relationship)
-            self.session.commit()
             self.session.flush()
+            # Stored in the outbox by the same transaction
+            self._enqueue_dhcp_(vlan, dhcp, 'new')
+            self.session.commit()
         except FlushError:
             self.session.rollback()
             raise DuplicatedEntryError('Dhcp', 'Entry already exist')
-        self._enqueue_dhcp_(vlan, dhcp, 'new')
+        except Exception, e:
+            self.session.rollback()
+            raise Exception(e)
         _data = dhcp.to_dict()
         self.logger.debug("Successful adding vlan to device:"
             " %s device status: %s" % (dhcp_id, _data)
         )
         return _data
 
-    def dhcp_list_by_vlan(self, vlan_id):
+    def dhcp_list_by_vlan(self, vlan_id, **kwargs):
         return self._generic_list_by_something_(
-            "Vlans_to_Dhcp", {'vlan_id': vlan_id}
+            "Vlans_to_Dhcp", {'vlan_id': vlan_id}, **kwargs
         )
 
     def dhcp_remove_vlan(self, dhcp_id, vlan_id):
@@ -99,19 +102,26 @@ class Net(SimpleNet):
         vlan_id = self.retrieve_valid_uuid(vlan_id, self.vlan_info_by_name, "id")
         dhcp = self.session.query(Dhcp).get(dhcp_id)
         vlan = self.session.query(Vlan).get(vlan_id)
-        ret = self._generic_delete_(
-            "Vlans_to_Dhcp",
-            {'vlan_id': vlan_id, 'dhcp_id': dhcp_id}
-        )
-        self._enqueue_dhcp_(vlan, dhcp, 'remove')
+        self.session.begin(subtransactions=True)
+        try:
+            ret = self._generic_delete_(
+                "Vlans_to_Dhcp",
+                {'vlan_id': vlan_id, 'dhcp_id': dhcp_id}
+            )
+            # Stored in the outbox by the same transaction
+            self._enqueue_dhcp_(vlan, dhcp, 'remove')
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
         return ret
 
-    def dhcp_info(self, id):
-        return self._generic_info_("Dhcp", {'id': id})
+    def dhcp_info(self, id, **kwargs):
+        return self._generic_info_("Dhcp", {'id': id}, **kwargs)
 
-    def dhcp_info_by_name(self, name):
+    def dhcp_info_by_name(self, name, **kwargs):
         return self._generic_info_(
-            "Dhcp", {'name': name}
+            "Dhcp", {'name': name}, **kwargs
         )
 
     def dhcp_update(self, *args, **kawrgs):
@@ -137,10 +147,10 @@ class Net(SimpleNet):
 
         if action == 'rebuild_queues':
             for dhcp in self.dhcp_list_by_vlan(vlan.id):
-                event.EventManager().raise_fanout_event(vlan.name, 'dhcp:'+dhcp['name'], _data)
+                self.events.raise_fanout_event(vlan.name, 'dhcp:'+dhcp['name'], _data)
         else:
-            event.EventManager().raise_fanout_event(vlan.name, 'dhcp:'+dhcp.name, _data)
-            event.EventManager().raise_event('dhcp:'+dhcp.name, _data)
+            self.events.raise_fanout_event(vlan.name, 'dhcp:'+dhcp.name, _data)
+            self.events.raise_event('dhcp:'+dhcp.name, _data)
 
     def _enqueue_dhcp_entries_(self, vlan, action):
         _data = {}
@@ -153,4 +163,4 @@ class Net(SimpleNet):
             for ip in self.ip_list_by_subnet(subnet.id):
                 entries.update({ip['ip']: [ip['interface_id'], ip['hostname'] or "defaulthostname"]})
 
-        event.EventManager().raise_fanout_event(vlan.name, '', {'network': _data, 'entries': entries, 'action': action})
+        self.events.raise_fanout_event(vlan.name, '', {'network': _data, 'entries': entries, 'action': action})
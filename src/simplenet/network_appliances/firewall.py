@@ -16,11 +16,16 @@
 # @author: Juliano Martinez (ncode), Locaweb.
 # @author: Luiz Ozaki, Locaweb.
 
+import hashlib
 import json
-from simplenet.common import event
-from simplenet.common.config import get_logger
-from simplenet.db.models import new_model, Firewall, Anycast, Anycasts_to_Firewall
+import threading
+
+from simplenet.common.config import config, get_logger
 from simplenet.db import db_utils
+from simplenet.db.models import (
+        new_model, Firewall, Vlan, Subnet, Ip, Anycast, Anycastip,
+        Anycasts_to_Firewall, Policy, ZonePolicy, Ruleset, FirewallState
+)
 from simplenet.exceptions import (
     FeatureNotAvailable, EntityNotFound,
     OperationNotPermited, DuplicatedEntryError
@@ -28,9 +33,94 @@ from simplenet.exceptions import (
 from simplenet.network_appliances.base import SimpleNet
 
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 logger = get_logger()
-session = db_utils.get_database_session()
+
+# Seconds the policy changes of a zone are gathered before its firewalls
+# get the new ruleset, so a bulk load compiles and pushes it once. 0
+# pushes it with every change.
+RECOMPILE_WINDOW = 0.2
+if config.has_option('server', 'firewall_recompile_window'):
+    RECOMPILE_WINDOW = config.getfloat('server', 'firewall_recompile_window')
+
+# zone id -> (last policy changed in the zone, tables of the policies
+# changed), for the zones waiting to be pushed, see Net.zones_flush
+_dirty_zones = {}
+_dirty_lock = threading.Lock()
+_flush_timer = [None]
+# Seconds before the zones of a failed push are pushed again, doubled
+# with every consecutive failure up to FLUSH_RETRY_MAX
+FLUSH_RETRY = 1
+FLUSH_RETRY_MAX = 60
+_flush_failures = [0]
+
+# Versions a firewall may be sent past the last one its agent
+# acknowledged before it gets the full ruleset again instead of a delta
+# from that one
+MAX_UNACKED = 20
+# Keys identifying the items of the lists of a ruleset
+ITEM_KEYS = ('id', 'vlan_id', 'anycast_id')
+
+def _item_key_(item):
+    for key in ITEM_KEYS:
+        if item.get(key):
+            return item[key]
+
+def _keyed_list_(value):
+    return type(value) is list and all(type(x) is dict and _item_key_(x) for x in value)
+
+def _hash_(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True)).hexdigest()
+
+def _fingerprint_(ruleset):
+    """
+    What _ruleset_delta_ needs to know of a ruleset sent: the hash of each
+    value, and of each item for the lists of items, policies and addresses
+    """
+    prints = {}
+    for key, value in ruleset.iteritems():
+        if _keyed_list_(value):
+            prints[key] = dict((_item_key_(x), _hash_(x)) for x in value)
+        else:
+            prints[key] = _hash_(value)
+    return prints
+
+def _ruleset_delta_(base, new):
+    """
+    Changes turning the ruleset fingerprinted as base into new: the values
+    replaced, and for the lists of items the ones added or changed along
+    with the keys of the ones removed
+    """
+    changes, lists = {}, {}
+    for key in set(base).union(new):
+        before, after = base.get(key), new.get(key)
+        if type(before) is dict and _keyed_list_(after):
+            upsert = [x for x in after if before.get(_item_key_(x)) != _hash_(x)]
+            after_keys = set(_item_key_(x) for x in after)
+            remove = [x for x in before if x not in after_keys]
+            if upsert or remove:
+                lists[key] = {'upsert': upsert, 'remove': remove}
+        elif before is None or before != _hash_(after):
+            changes[key] = after
+    return changes, lists
+
+def _schedule_flush_(delay):
+    """Starts the timer pushing the changed zones, unless one is pending. Needs _dirty_lock."""
+    if _flush_timer[0] is None:
+        _flush_timer[0] = threading.Timer(delay, _flush_dirty_zones_)
+        _flush_timer[0].start()
+
+def _flush_dirty_zones_():
+    with _dirty_lock:
+        _flush_timer[0] = None
+    session = db_utils.get_database_session()
+    try:
+        Net(session).zones_flush()
+    except Exception:
+        logger.exception("Failed to push the rulesets of the changed zones")
+    finally:
+        session.close()
 
 class Net(SimpleNet):
 
@@ -51,25 +141,25 @@ class Net(SimpleNet):
         }
 
     def firewall_enable(self, data):
-        session.begin()
+        self.session.begin()
         try:
-            firewall = session.query(Firewall).filter_by(**data).first()
+            firewall = self.session.query(Firewall).filter_by(**data).first()
             firewall.enable()
-            session.commit()
+            self.session.commit()
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
         logger.info("Firewall %s enabled" % firewall.name)
         return firewall.to_dict()
 
     def firewall_disable(self, data):
-        session.begin()
+        self.session.begin()
         try:
-            firewall = session.query(Firewall).filter_by(**data).first()
+            firewall = self.session.query(Firewall).filter_by(**data).first()
             firewall.disable()
-            session.commit()
+            self.session.commit()
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
         logger.info("Firewall %s disabled" % firewall.name)
         return firewall.to_dict()
@@ -77,13 +167,13 @@ class Net(SimpleNet):
     def firewall_create(self, data):
         logger.debug("Creating device using data: %s" % data)
 
-        session.begin(subtransactions=True)
+        self.session.begin(subtransactions=True)
         try:
-            session.add(Firewall(name=data['name'], zone_id=data['zone_id'],
+            self.session.add(Firewall(name=data['name'], zone_id=data['zone_id'],
                                         mac=data['mac'], status=True))
-            session.commit()
+            self.session.commit()
         except IntegrityError, e:
-            session.rollback()
+            self.session.rollback()
             msg = str(e)
             if msg.find("foreign key constraint failed") != -1:
                 forbidden_msg = "zone_id %s doesnt exist" % zone_id
@@ -93,14 +183,14 @@ class Net(SimpleNet):
                 forbidden_msg = "Unknown error"
             raise OperationNotPermited('Firewall', forbidden_msg)
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
         logger.debug("Created device using data: %s" % data)
 
         return self.firewall_info_by_name(data['name'])
 
-    def firewall_list(self):
-        return self._generic_list_("Firewall")
+    def firewall_list(self, **kwargs):
+        return self._generic_list_("Firewall", **kwargs)
 
     def firewall_add_anycast(self, firewall_id, data):
         logger.debug("Adding vlan to anycast: %s using data: %s" %
@@ -108,49 +198,54 @@ class Net(SimpleNet):
         )
         firewall_id = self.retrieve_valid_uuid(firewall_id, self.firewall_info_by_name, "id")
 
-        firewall = session.query(Firewall).get(firewall_id)
-        anycast = session.query(Anycast).get(data['anycast_id'])
+        firewall = self.session.query(Firewall).get(firewall_id)
+        anycast = self.session.query(Anycast).get(data['anycast_id'])
 
-        session.begin(subtransactions=True)
+        self.session.begin(subtransactions=True)
         try:
             relationship = Anycasts_to_Firewall()
             relationship.anycast = anycast
             firewall.anycasts_to_firewalls.append(relationship)
-            session.commit()
+            self.session.commit()
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
+        self._bump_zones_([firewall.zone_id])
         _data = firewall.to_dict()
         logger.debug("Successful adding vlan to anycast: %s device status: %s" %
             (firewall_id, _data)
         )
         return _data
 
-    def firewall_list_by_vlan(self, vlan_id):
+    def firewall_list_by_vlan(self, vlan_id, **kwargs):
         return self._generic_list_by_something_(
-            "Vlans_to_Firewall", {'vlan_id': vlan_id}
+            "Vlans_to_Firewall", {'vlan_id': vlan_id}, **kwargs
         )
 
-    def firewall_list_by_anycast(self, anycast_id):
+    def firewall_list_by_anycast(self, anycast_id, **kwargs):
         return self._generic_list_by_something_(
             "Anycasts_to_Firewall",
-            {'anycast_id': anycast_id}
+            {'anycast_id': anycast_id}, **kwargs
         )
 
     def firewall_remove_anycast(self, firewall_id, anycast_id):
         firewall_id = self.retrieve_valid_uuid(firewall_id, self.firewall_info_by_name, "id")
 
-        return self._generic_delete_(
+        ret = self._generic_delete_(
             "Anycasts_to_Firewall",
             {'anycast_id': anycast_id, 'firewall_id': firewall_id}
         )
+        self._bump_zones_(
+            [x[0] for x in self.session.query(Firewall.zone_id).filter_by(id=firewall_id)]
+        )
+        return ret
 
-    def firewall_info(self, id):
-        return self._generic_info_("Firewall", {'id': id})
+    def firewall_info(self, id, **kwargs):
+        return self._generic_info_("Firewall", {'id': id}, **kwargs)
 
-    def firewall_info_by_name(self, name):
+    def firewall_info_by_name(self, name, **kwargs):
         return self._generic_info_(
-            "Firewall", {'name': name}
+            "Firewall", {'name': name}, **kwargs
         )
 
     def firewall_update(self, *args, **kawrgs):
@@ -173,23 +268,67 @@ class Net(SimpleNet):
         if device is None:
             raise EntityNotFound("Firewall", "not found with %s" % data)
 
+        # A reload is always sent in full
+        self._ruleset_acked_(device['id'], 0)
         self._enqueue_device_rules_(_data, [device], "FW Reload")
 
         return device
 
     def _enqueue_rules_(self, owner_type, owner_id, mod):
-        logger.debug("Getting rules from %s with id %s" % (owner_type, owner_id))
-        policy_list = []
-        _get_data = getattr(self, "_get_data_%s_" % owner_type)
-        zone_id = _get_data(owner_id).get('zone_id')
-        _data = {}
-        #_data = _get_data(owner_id)
-        _data['modified'] = mod
-
-        logger.debug("Getting devices by zone: %s" % zone_id)
-        devices = self.firewall_list_by_zone(zone_id)
-
-        self._enqueue_device_rules_(_data, devices, owner_type)
+        """
+        Marks the zones of the owner as changed. Their firewalls get the
+        new ruleset within RECOMPILE_WINDOW, once for all the changes made
+        meanwhile.
+        """
+        logger.debug("Getting zones of %s with id %s" % (owner_type, owner_id))
+        zone_ids = self._zones_of_(owner_type, owner_id)
+
+        with _dirty_lock:
+            for zone_id in zone_ids:
+                tables = _dirty_zones.get(zone_id, (None, set()))[1]
+                tables.add(mod.get('table'))
+                _dirty_zones[zone_id] = (mod, tables)
+            if RECOMPILE_WINDOW > 0:
+                _schedule_flush_(RECOMPILE_WINDOW)
+        if RECOMPILE_WINDOW <= 0:
+            self.zones_flush(zone_ids)
+
+    def zones_flush(self, zone_ids=None):
+        """
+        Pushes the ruleset of the changed zones, of zone_ids only when
+        given, right away instead of at the end of RECOMPILE_WINDOW.
+        Along with the last policy changed, modified, the rulesets carry
+        the tables of all the changed ones, for the agents to build the
+        jumps of each. Returns how many zones were pushed.
+
+        When a push fails, the zones left are pushed again after
+        FLUSH_RETRY seconds, backing off while it keeps failing.
+        """
+        with _dirty_lock:
+            keys = [x for x in _dirty_zones if zone_ids is None or x in zone_ids]
+            pending = [(x, _dirty_zones.pop(x)) for x in keys]
+
+        for index, (zone_id, (mod, tables)) in enumerate(pending):
+            logger.debug("Getting devices by zone: %s" % zone_id)
+            try:
+                devices = self.firewall_list_by_zone(zone_id)
+                self._enqueue_device_rules_({'modified': mod, 'tables': sorted(tables)},
+                                            devices, "zone")
+            except Exception:
+                # Left to the next flush, along with what changed meanwhile
+                with _dirty_lock:
+                    for key, (mod, tables) in pending[index:]:
+                        if key in _dirty_zones:
+                            _dirty_zones[key][1].update(tables)
+                        else:
+                            _dirty_zones[key] = (mod, tables)
+                    _flush_failures[0] += 1
+                    _schedule_flush_(min(FLUSH_RETRY * 2 ** (_flush_failures[0] - 1),
+                                         FLUSH_RETRY_MAX))
+                raise
+        if pending:
+            _flush_failures[0] = 0
+        return len(pending)
 
     def _enqueue_device_rules_(self, data, devices, owner_type):
         policy_list = []
@@ -204,37 +343,18 @@ class Net(SimpleNet):
                 logger.info("Device %s ignored, status disabled" % device.get("name"))
                 continue
             logger.debug("Getting data from device: %s" % device['id'])
-            owners_ids = []
             zone_id = device['zone_id']
 
             if cache.get(zone_id):
                 logger.info("Sending cached event to %s" % device['name'])
-                event.EventManager().raise_event(device['name'], cache.get(zone_id))
+                self._send_ruleset_(device, cache.get(zone_id))
             else:
                 _data = data
-                _data.update(self._get_data_zone_(zone_id))
-                _data['anycasts'] = []
-                _data['anycastips'] = []
                 dev_id = device.get('device_id') or device.get('id')
 
-                logger.debug("Getting policy data from zone %s" % zone_id)
-                policy_list += self.policy_list_by_owner('zone', zone_id)
-                for vlan in self.vlan_list_by_zone(zone_id): # Cascade thru the vlans of the device
-                    owners_ids.append(vlan['id'])
-                    for subnet in self.subnet_list_by_vlan(vlan['id']): # Cascade thru the subnets of the vlan
-                        owners_ids.append(subnet['id'])
-                        for ip in self.ip_list_by_subnet(subnet['id']): # Cascade thru the IPs of the subnet
-                            owners_ids.append(ip['id'])
-
-                for anycast in self.anycast_list_by_firewall(dev_id): # Cascade thru the anycasts of the device
-                    owners_ids.append(anycast['anycast_id'])
-                    _data['anycasts'].append(anycast)
-                    for anycastip in self.anycastip_list_by_anycast(anycast['anycast_id']): # Cascade thru the IPs of the anycast subnet
-                        _data['anycastips'].append(anycastip)
-                        owners_ids.append(anycastip['id'])
-
-                logger.debug("Getting policy data")
-                policy_list += self.policy_list_by_owners(owners_ids)
+                ruleset = self._get_ruleset_(zone_id, dev_id)
+                policy_list += ruleset.pop('policy')
+                _data.update(ruleset)
 
                 _data.update({'policy': policy_list})
                 logger.debug("Received rules: %s from %s with id %s and device %s" % (
@@ -243,10 +363,145 @@ class Net(SimpleNet):
                 if policy_list:
                     logger.info("Sending event to %s" % device['name'])
                     cache[zone_id] = _data
-                    event.EventManager().raise_event(device['name'], _data)
+                    self._send_ruleset_(device, _data)
+
+    def _send_ruleset_(self, device, payload):
+        """
+        Sends payload to device under its next version. Agents which
+        acknowledged one of the last MAX_UNACKED versions get the delta
+        from it, which holds whatever was sent since, lost or not. The
+        others get the full ruleset.
+        """
+        dev_id = device.get('device_id') or device.get('id')
+        self.session.begin(subtransactions=True)
+        try:
+            state = self.session.query(FirewallState).filter_by(
+                firewall_id=dev_id
+            ).with_lockmode('update').first()
+            if state is None:
+                state = FirewallState(dev_id)
+                self.session.add(state)
+            version = state.version + 1
+            sent = json.loads(state.sent or '{}')
+            base = sent.get(str(state.acked)) if state.acked else None
+            if base is not None and version - state.acked <= MAX_UNACKED:
+                changes, lists = _ruleset_delta_(base, payload)
+                message = {'delta': True, 'base': state.acked, 'version': version,
+                           'changes': changes, 'lists': lists}
+            else:
+                message = dict(payload, version=version)
+            sent[str(version)] = _fingerprint_(payload)
+            # Older ones will not be deltas bases anymore
+            state.sent = json.dumps(dict(
+                (x, y) for x, y in sent.iteritems()
+                if int(x) >= state.acked and int(x) > version - MAX_UNACKED
+            ))
+            state.version = version
+            self.events.raise_event(device['name'], message)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def _ruleset_acked_(self, firewall_id, version):
+        """
+        Records version as applied by the agent of firewall_id, the base of
+        the next delta. 0 means it has none, for it to get the full ruleset.
+        """
+        self.session.begin(subtransactions=True)
+        try:
+            state = self.session.query(FirewallState).filter_by(
+                firewall_id=firewall_id
+            ).with_lockmode('update').first()
+            if state is not None:
+                state.acked = version and max(state.acked, min(version, state.version))
+                sent = json.loads(state.sent or '{}')
+                state.sent = json.dumps(dict(
+                    (x, y) for x, y in sent.iteritems() if int(x) >= state.acked
+                ) if state.acked else {})
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def ruleset_ack(self, name, version):
+        """Records version as applied by the agent of the firewall name"""
+        try:
+            device = self.firewall_info_by_name(name)
+        except EntityNotFound:
+            logger.error("Ruleset %s of firewall %s could not be acked -- Not Found" % (version, name))
+            return
+        self._ruleset_acked_(device['id'], int(version))
+
+    def ruleset_resync(self, name):
+        """Sends the full ruleset to the firewall name, its agent lost track of the deltas"""
+        logger.info("Resyncing the ruleset of firewall %s" % name)
+        return self.firewall_sync({'name': name})
+
+    def _get_ruleset_(self, zone_id, device_id):
+        """
+        Returns the stored ruleset of the device when the zone did not change
+        since it was compiled, compiling and storing a new one otherwise
+        """
+        version = self._zone_version_(zone_id)
+        stored = self.session.query(Ruleset.version, Ruleset.payload).filter_by(
+            zone_id=zone_id, firewall_id=device_id
+        ).first()
+        if stored and stored.version == version:
+            logger.debug("Using stored ruleset of zone %s version %s" % (zone_id, version))
+            return json.loads(stored.payload)
+
+        logger.debug("Compiling ruleset of zone %s version %s" % (zone_id, version))
+        ruleset = self._compile_ruleset_(zone_id, device_id)
+        self.session.begin(subtransactions=True)
+        try:
+            self.session.merge(Ruleset(zone_id=zone_id, firewall_id=device_id,
+                                       version=version, payload=json.dumps(ruleset)))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            logger.exception("Failed to store ruleset of zone %s" % zone_id)
+        return ruleset
+
+    def _compile_ruleset_(self, zone_id, device_id):
+        """
+        Builds the zone tree, the anycasts of the device and every policy
+        owned by the zone or anything below it using a fixed number of queries
+        """
+        zone, datacenter, vlans, subnets = self._load_zone_(zone_id)
+        _data = self._zone_tree_(zone, datacenter, vlans, subnets)
+
+        anycasts = self.session.query(Anycasts_to_Firewall).filter_by(
+            firewall_id=device_id
+        ).options(joinedload('anycast')).all()
+        anycast_ids = self.session.query(Anycasts_to_Firewall.anycast_id).filter_by(
+            firewall_id=device_id
+        )
+        anycastips = {}
+        for anycastip in self.session.query(Anycastip).filter(
+                Anycastip.anycast_id.in_(anycast_ids)):
+            anycastips.setdefault(anycastip.anycast_id, []).append(anycastip)
+
+        _data['anycasts'] = [x.to_dict() for x in anycasts]
+        _data['anycastips'] = [ip.to_dict() for x in anycasts
+                                  for ip in anycastips.get(x.anycast_id, [])]
+
+        vlan_ids = self.session.query(Vlan.id).filter(Vlan.zone_id == zone_id)
+        subnet_ids = self.session.query(Subnet.id).filter(Subnet.vlan_id.in_(vlan_ids))
+        owners = vlan_ids.union(
+            subnet_ids,
+            self.session.query(Ip.id).filter(Ip.subnet_id.in_(subnet_ids)),
+            anycast_ids,
+            self.session.query(Anycastip.id).filter(Anycastip.anycast_id.in_(anycast_ids)),
+        )
+        # Owners are all loaded above, so to_dict resolves them from the identity map
+        policies = self.session.query(ZonePolicy).filter_by(owner_id=zone_id).all()
+        policies += self.session.query(Policy).filter(Policy.owner_id.in_(owners)).all()
+        _data['policy'] = [x.to_dict() for x in policies]
+        return _data
 
-    def policy_list(self, owner_type):
-        return self._generic_list_("%sPolicy" % owner_type.capitalize())
+    def policy_list(self, owner_type, **kwargs):
+        return self._generic_list_("%sPolicy" % owner_type.capitalize(), **kwargs)
 
     def policy_create(self, owner_type, owner_id, data):
         logger.debug("Creating rule on %s: %s using data: %s" %
@@ -256,20 +511,21 @@ class Net(SimpleNet):
         _model, _ = new_model("%sPolicy" % owner_type.capitalize())
         policy = _model(**data)
 
-        session.begin(subtransactions=True)
+        self.session.begin(subtransactions=True)
         try:
-            session.add(policy)
-            session.commit()
+            self.session.add(policy)
+            self.session.commit()
         except IntegrityError:
-            session.rollback()
+            self.session.rollback()
             raise DuplicatedEntryError('Firewall', "%s already exists" % data)
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
 
         logger.debug("Created rule %s on %s: %s using data: %s" %
             (policy.id, owner_type, owner_id, data)
         )
+        self._touch_zones_(owner_type, owner_id)
         pol = self.policy_info(owner_type, policy.id)
 
         try:
@@ -281,20 +537,22 @@ class Net(SimpleNet):
 
     def policy_ack(self, id):
         _model, _ = new_model("Policy")
-        ss = session.query(_model).get(id)
+        ss = self.session.query(_model).get(id)
         if not ss:
             logger.error("Policy [%s] could not be acked -- Not Found" % id)
         else:
-            session.begin(subtransactions=True)
+            owner_type, owner_id = ss.owner_type, ss.owner_id
+            self.session.begin(subtransactions=True)
             try:
                 ss.status = "INSERTED"
-                session.commit()
+                self.session.commit()
             except Exception, e:
-                session.rollback()
+                self.session.rollback()
                 raise e
+            self._touch_zones_(owner_type, owner_id)
 
-    def policy_info(self, owner_type, id):
-        return self._generic_info_("%sPolicy" % owner_type.capitalize(), {'id': id})
+    def policy_info(self, owner_type, id, **kwargs):
+        return self._generic_info_("%sPolicy" % owner_type.capitalize(), {'id': id}, **kwargs)
 
     def policy_update(self, *args, **kwargs):
         raise FeatureNotAvailable()
@@ -302,44 +560,46 @@ class Net(SimpleNet):
     def policy_delete(self, owner_type, id):
         logger.debug("Deleting policy %s" % id)
         _model, _ = new_model("%sPolicy" % owner_type.capitalize())
-        ss = session.query(_model).get(id)
+        ss = self.session.query(_model).get(id)
         if not ss:
             return True
         modified = ss.to_dict()
         owner_id = ss.owner_id
-        session.begin(subtransactions=True)
+        self.session.begin(subtransactions=True)
         try:
-            session.delete(ss)
-            session.commit()
+            self.session.delete(ss)
+            self.session.commit()
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
 
         logger.debug("Successful deletion of policy %s" % id)
+        self._touch_zones_(owner_type, owner_id)
         self._enqueue_rules_(owner_type, owner_id, modified)
         return True
 
     def policy_delete_by_owner(self, owner_type, id):
         _model, _ = new_model("%sPolicy" % owner_type.capitalize())
-        ss = session.query(_model).filter_by(**{'owner_id': id}).all()
+        ss = self.session.query(_model).filter_by(**{'owner_id': id}).all()
         if ss:
-            session.begin(subtransactions=True)
+            self.session.begin(subtransactions=True)
             try:
                 entries = []
                 for s in ss:
                     entries.append(s.to_dict())
-                    session.delete(s)
-                session.commit()
+                    self.session.delete(s)
+                self.session.commit()
             except Exception, e:
-                session.rollback()
+                self.session.rollback()
                 raise Exception(e)
 
+            self._touch_zones_(owner_type, id)
             for modified in entries:
                 self._enqueue_rules_(owner_type, id, modified)
 
-    def policy_list_by_owner(self, owner_type, id):
+    def policy_list_by_owner(self, owner_type, id, **kwargs):
         return self._generic_list_by_something_(
-            "%sPolicy" % owner_type.capitalize(), {'owner_id': id}
+            "%sPolicy" % owner_type.capitalize(), {'owner_id': id}, **kwargs
         )
 
     def policy_list_by_owners(self, ids):
@@ -347,7 +607,7 @@ class Net(SimpleNet):
             return []
         model, _ = new_model("Policy")
         logger.debug("Getting policies by ids %s" % (ids))
-        ss = session.query(model).filter(model.owner_id.in_(ids)).all()
+        ss = self.session.query(model).filter(model.owner_id.in_(ids)).all()
         _values = []
         for _value in ss:
             _values.append(
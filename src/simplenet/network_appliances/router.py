@@ -20,7 +20,6 @@ import json
 from simplenet.common import event
 from simplenet.common.config import get_logger
 from simplenet.db.models import new_model, Router
-from simplenet.db import db_utils
 from simplenet.exceptions import (
     FeatureNotAvailable, EntityNotFound,
     OperationNotPermited, DuplicatedEntryError
@@ -30,7 +29,6 @@ from simplenet.network_appliances.base import SimpleNet
 from sqlalchemy.exc import IntegrityError
 
 logger = get_logger()
-session = db_utils.get_database_session()
 
 class Net(SimpleNet):
 
@@ -51,25 +49,25 @@ class Net(SimpleNet):
         }
 
     def router_enable(self, data):
-        session.begin()
+        self.session.begin()
         try:
-            router = session.query(Router).filter_by(**data).first()
+            router = self.session.query(Router).filter_by(**data).first()
             router.enable()
-            session.commit()
+            self.session.commit()
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
         logger.info("Router %s enabled" % router.name)
         return router.to_dict()
 
     def router_disable(self, data):
-        session.begin()
+        self.session.begin()
         try:
-            router = session.query(Router).filter_by(**data).first()
+            router = self.session.query(Router).filter_by(**data).first()
             router.disable()
-            session.commit()
+            self.session.commit()
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
         logger.info("Router %s disabled" % router.name)
         return router.to_dict()
@@ -77,13 +75,13 @@ class Net(SimpleNet):
     def router_create(self, data):
         logger.debug("Creating device using data: %s" % data)
 
-        session.begin(subtransactions=True)
+        self.session.begin(subtransactions=True)
         try:
-            session.add(Router(name=data['name'], zone_id=data['zone_id'],
+            self.session.add(Router(name=data['name'], zone_id=data['zone_id'],
                                         mac=data['mac'], status=True))
-            session.commit()
+            self.session.commit()
         except IntegrityError, e:
-            session.rollback()
+            self.session.rollback()
             msg = str(e)
             if msg.find("foreign key constraint failed") != -1:
                 forbidden_msg = "zone_id %s doesnt exist" % zone_id
@@ -93,26 +91,26 @@ class Net(SimpleNet):
                 forbidden_msg = "Unknown error"
             raise OperationNotPermited('Router', forbidden_msg)
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
         logger.debug("Created device using data: %s" % data)
 
         return self.router_info_by_name(data['name'])
 
-    def router_list(self):
-        return self._generic_list_("Router")
+    def router_list(self, **kwargs):
+        return self._generic_list_("Router", **kwargs)
 
-    def router_list_by_vlan(self, vlan_id):
+    def router_list_by_vlan(self, vlan_id, **kwargs):
         return self._generic_list_by_something_(
-            "Vlans_to_Router", {'vlan_id': vlan_id}
+            "Vlans_to_Router", {'vlan_id': vlan_id}, **kwargs
         )
 
-    def router_info(self, id):
-        return self._generic_info_("Router", {'id': id})
+    def router_info(self, id, **kwargs):
+        return self._generic_info_("Router", {'id': id}, **kwargs)
 
-    def router_info_by_name(self, name):
+    def router_info_by_name(self, name, **kwargs):
         return self._generic_info_(
-            "Router", {'name': name}
+            "Router", {'name': name}, **kwargs
         )
 
     def router_update(self, *args, **kawrgs):
@@ -16,10 +16,8 @@
 # @author: Juliano Martinez (ncode), Locaweb.
 # @author: Luiz Ozaki, Locaweb.
 
-from simplenet.common import event
 from simplenet.common.config import get_logger
 from simplenet.db.models import Switch, Interface, Router
-from simplenet.db import db_utils
 from simplenet.exceptions import (
     FeatureNotAvailable, EntityNotFound,
     OperationNotPermited, DuplicatedEntryError
@@ -29,37 +27,36 @@ from simplenet.network_appliances.base import SimpleNet
 from sqlalchemy.exc import IntegrityError
 
 logger = get_logger()
-session = db_utils.get_database_session()
 
 
 class Net(SimpleNet):
-    def switch_list(self):
-        return self._generic_list_("Switch")
+    def switch_list(self, **kwargs):
+        return self._generic_list_("Switch", **kwargs)
 
     def switch_create(self, data):
         logger.debug("Creating device using data: %s" % data)
 
-        session.begin(subtransactions=True)
+        self.session.begin(subtransactions=True)
         try:
-            session.add(Switch(name=data['name'], mac=data['mac'],
+            self.session.add(Switch(name=data['name'], mac=data['mac'],
                                     address=data['address'], model_type=data['model_type']))
-            session.commit()
+            self.session.commit()
         except IntegrityError:
-            session.rollback()
+            self.session.rollback()
             raise DuplicatedEntryError('Switch', "%s already exists" % data['name'])
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
 
         return self.switch_info_by_name(data['name'])
 
-    def switch_info(self, id):
-        return self._generic_info_("Switch", {'id': id})
+    def switch_info(self, id, **kwargs):
+        return self._generic_info_("Switch", {'id': id}, **kwargs)
 
 
-    def switch_info_by_name(self, name):
+    def switch_info_by_name(self, name, **kwargs):
         return self._generic_info_(
-            "Switch", {'name': name}
+            "Switch", {'name': name}, **kwargs
         )
 
     def switch_update(self, *args, **kawrgs):
@@ -71,44 +68,48 @@ class Net(SimpleNet):
     def switch_add_interface(self, switch_id, data):
         logger.debug("Adding interface using data: %s" % data)
 
-        interface = session.query(Interface).get(data['interface_id'])
+        interface = self.session.query(Interface).get(data['interface_id'])
         switch_id = self.retrieve_valid_uuid(switch_id, self.switch_info_by_name, "id")
 
         if not interface:
             raise EntityNotFound('Interface', data['interface_id'])
 
-        if interface.switch_id:
-            self.switch_remove_interface(interface.switch_id, data['interface_id'])
-
-        session.begin(subtransactions=True)
+        self.session.begin(subtransactions=True)
         try:
+            if interface.switch_id:
+                self.switch_remove_interface(interface.switch_id, data['interface_id'])
+
             interface.switch_id = switch_id
             interface.name = data['int_name']
-            session.commit()
+            self.session.flush()
+            # Loads the switch just set
+            self.session.expire(interface)
+
+            _data = interface.tree_dict()
+            _data['action'] = "plug"
+            _data['ofport'] = data.get('ofport')
+            _data['bridgeport'] = data.get('bridgeport')
+            zones = set()
+            for ip in _data['ips']:
+                zones.add(ip['subnet']['vlan']['zone_id'])
+
+            _data['routers'] = []
+            for zone in zones:
+                for router in self.router_list_by_zone(zone):
+                    _data['routers'].append(router) if router.get("mac") is not None else None
+
+            # Stored in the outbox by the same transaction
+            self.events.raise_event(_data['switch_id']['name'].split(":")[0], _data)
+            self.session.commit()
         except Exception, e:
-            session.rollback()
+            self.session.rollback()
             raise Exception(e)
-
-        _data = interface.tree_dict()
         logger.debug("Successful adding Interface to Switch status: %s" % _data)
-        _data['action'] = "plug"
-        _data['ofport'] = data.get('ofport')
-        _data['bridgeport'] = data.get('bridgeport')
-        zones = set()
-        for ip in _data['ips']:
-            zones.add(ip['subnet']['vlan']['zone_id'])
-
-        _data['routers'] = []
-        for zone in zones:
-            for router in self.router_list_by_zone(zone):
-                _data['routers'].append(router) if router.get("mac") is not None else None
-
-        event.EventManager().raise_event(_data['switch_id']['name'].split(":")[0], _data)
 
         return _data
 
     def switch_remove_interface(self, switch_id, int_id):
-        interface = session.query(Interface).get(int_id)
+        interface = self.session.query(Interface).get(int_id)
         if not interface:
             raise EntityNotFound('Interface', int_id)
 
@@ -118,17 +119,17 @@ class Net(SimpleNet):
             return
         elif interface.switch_id == switch_id:
             _data = interface.tree_dict()
-            session.begin(subtransactions=True)
+            _data['action'] = "unplug"
+            self.session.begin(subtransactions=True)
             try:
                 interface.switch_id = None
-                session.commit()
+                # Stored in the outbox by the same transaction
+                self.events.raise_event(_data['switch_id']['name'].split(":")[0], _data)
+                self.session.commit()
             except Exception, e:
-                session.rollback()
+                self.session.rollback()
                 raise Exception(e)
 
-            _data['action'] = "unplug"
-            event.EventManager().raise_event(_data['switch_id']['name'].split(":")[0], _data)
-
             return _data
         else:
             raise Exception("Interface not plugged into the switch")
@@ -24,7 +24,8 @@ from bottle import request, response
 from simplenet.common.auth import handle_auth
 from simplenet.common.config import get_logger
 from simplenet.common.http_utils import (
-    reply_json, create_manager, validate_input, clear_cache, cache
+    reply_json, create_manager, validate_input, cache, cache_stats,
+    list_args, info_args
 )
 from simplenet.exceptions import (
     FeatureNotAvailable
@@ -78,10 +79,43 @@ def generic_prober():
         raise FeatureNotAvailable()
 
 
+@get('/v1/prober/pools')
+@handle_auth
+@reply_json
+def generic_prober_pools():
+    """
+    ::
+
+      GET /v1/prober/pools
+
+    Connection pool counters of each database engine
+    """
+    manager = create_manager('base')
+    try:
+        _list = getattr(manager, 'pool_stats')
+        return _list()
+    except AttributeError:
+        raise FeatureNotAvailable()
+
+
+@get('/v1/prober/cache')
+@handle_auth
+@reply_json
+def generic_prober_cache():
+    """
+    ::
+
+      GET /v1/prober/cache
+
+    Response cache counters of this server process
+    """
+    return cache_stats()
+
+
 @get('/v1/datacenters')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='datacenters')
 def datacenters_list():
     """
     ::
@@ -93,7 +127,7 @@ def datacenters_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'datacenter_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -101,7 +135,7 @@ def datacenters_list():
 @get('/v1/zones')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='zones')
 def zone_list():
     """
     ::
@@ -113,7 +147,7 @@ def zone_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'zone_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -121,7 +155,7 @@ def zone_list():
 @get('/v1/vlans')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='vlans')
 def vlan_list():
     """
     ::
@@ -133,7 +167,7 @@ def vlan_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'vlan_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -141,7 +175,7 @@ def vlan_list():
 @get('/v1/subnets')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='subnets')
 def subnet_list():
     """
     ::
@@ -153,7 +187,7 @@ def subnet_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'subnet_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -161,7 +195,7 @@ def subnet_list():
 @get('/v1/anycasts')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='anycasts')
 def anycast_list():
     """
     ::
@@ -173,7 +207,7 @@ def anycast_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'anycast_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -181,7 +215,7 @@ def anycast_list():
 @get('/v1/ips')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='ips')
 def ip_list():
     """
     ::
@@ -193,7 +227,7 @@ def ip_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'ip_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -201,7 +235,7 @@ def ip_list():
 @get('/v1/anycastips')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='anycastips')
 def anycastip_list():
     """
     ::
@@ -213,7 +247,7 @@ def anycastip_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'anycastip_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -221,7 +255,7 @@ def anycastip_list():
 @get('/v1/dhcps')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='dhcps')
 def dhcp_list():
     """
     ::
@@ -233,7 +267,7 @@ def dhcp_list():
     manager = create_manager('dhcp')
     try:
         _list = getattr(manager, 'dhcp_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -241,7 +275,7 @@ def dhcp_list():
 @get('/v1/interfaces')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='interfaces')
 def interface_list():
     """
     ::
@@ -253,7 +287,7 @@ def interface_list():
     manager = create_manager('base')
     try:
         _list = getattr(manager, 'interface_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -261,7 +295,7 @@ def interface_list():
 @get('/v1/firewalls')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='firewalls')
 def firewall_list():
     """
     ::
@@ -273,7 +307,7 @@ def firewall_list():
     manager = create_manager('firewall')
     try:
         _list = getattr(manager, 'firewall_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -281,7 +315,7 @@ def firewall_list():
 @get('/v1/routers')
 @handle_auth
 @reply_json
-@cache()
+@cache(resource='routers')
 def router_list():
     """
     ::
@@ -293,15 +327,97 @@ def router_list():
     manager = create_manager('router')
     try:
         _list = getattr(manager, 'router_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
 
+
+@get('/v1/lookup/<ip>')
+@handle_auth
+@reply_json
+def prefix_lookup(ip):
+    """
+    ::
+
+      GET /v1/lookup/<ip>
+
+    Retrieves the subnet and the anycast holding ip from the in-memory
+    prefix index
+    """
+    manager = create_manager('base')
+    return manager.prefix_lookup(ip)
+
+
+@get('/v1/subnets/containing/<ip>')
+@handle_auth
+@reply_json
+@cache(resource='subnets')
+def subnet_containing(ip):
+    """
+    ::
+
+      GET /v1/subnets/containing/<ip>
+
+    Retrieves the most specific subnet holding ip
+    """
+    manager = create_manager('base')
+    return manager.subnet_containing(ip)
+
+
+@get('/v1/subnets/overlapping/<cidr>')
+@handle_auth
+@reply_json
+@cache(resource='subnets')
+def subnet_list_overlapping(cidr):
+    """
+    ::
+
+      GET /v1/subnets/overlapping/<cidr>
+
+    Retrieves all subnets overlapping cidr, written as 10.0.0.0_24
+    """
+    manager = create_manager('base')
+    return manager.subnet_list_overlapping(cidr)
+
+
+@get('/v1/anycasts/containing/<ip>')
+@handle_auth
+@reply_json
+@cache(resource='anycasts')
+def anycast_containing(ip):
+    """
+    ::
+
+      GET /v1/anycasts/containing/<ip>
+
+    Retrieves the most specific anycast holding ip
+    """
+    manager = create_manager('base')
+    return manager.anycast_containing(ip)
+
+
+@get('/v1/ips/range/<first>/<last>')
+@handle_auth
+@reply_json
+@cache(resource='ips')
+def ip_list_in_range(first, last):
+    """
+    ::
+
+      GET /v1/ips/range/<first>/<last>
+
+    Retrieves all ips between first and last, both included
+    """
+    manager = create_manager('base')
+    return manager.ip_list_in_range(first, last)
+
+
 ## Generic Resource Info
 @get('/v1/<resource>/<resource_id>')
 @handle_auth
 @reply_json
+@cache(tagged=True)
 def generic_resource_info(resource, resource_id):
     """
     ::
@@ -313,7 +429,7 @@ def generic_resource_info(resource, resource_id):
     manager = create_manager(generic_router(resource))
     try:
         _info = getattr(manager, '%s_info' % resource_map.get(resource))
-        return _info(resource_id)
+        return _info(resource_id, **info_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -322,7 +438,7 @@ def generic_resource_info(resource, resource_id):
 @get('/v1/<resource>/by-<resource_type>/<resource_value>')
 @handle_auth
 @reply_json
-@cache()
+@cache(tagged=True)
 def generic_resource_info_by_field(resource, resource_type, resource_value):
     """
     ::
@@ -334,10 +450,11 @@ def generic_resource_info_by_field(resource, resource_type, resource_value):
     manager = create_manager(generic_router(resource))
     try:
         _info = getattr(manager, '%s_info_by_%s' % (resource_map.get(resource), resource_type))
-        if type(_info(resource_value)) != list:
-            return [_info(resource_value)]
+        info = _info(resource_value, **info_args())
+        if type(info) != list:
+            return [info]
         else:
-            return _info(resource_value)
+            return info
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -357,7 +474,7 @@ def generic_resource_list_by_relationship(resource, relationship_type, relations
     manager = create_manager(generic_router(resource))
     try:
         _list = getattr(manager, '%s_list_by_%s' % (resource_map.get(resource), relationship_type))
-        return _list(relationship_value)
+        return _list(relationship_value, **list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -374,7 +491,6 @@ def generic_resource_delete(resource, resource_id):
 
     Deletes resource
     """
-    clear_cache()
     manager = create_manager(generic_router(resource))
     try:
         _delete = getattr(manager, '%s_delete' % (resource_map.get(resource)))
@@ -403,7 +519,6 @@ def datacenter_create():
     datacenter = manager.datacenter_create(data)
     location = "datacenters/%s" % (datacenter['id'])
     response.set_header("Location", location)
-    clear_cache()
     return datacenter
 
 
@@ -427,7 +542,6 @@ def datacenter_zone_create():
     zone = manager.zone_create(data['datacenter_id'], data)
     location = "zones/%s" % (zone['id'])
     response.set_header("Location", location)
-    clear_cache()
     return zone
 
 
@@ -451,7 +565,6 @@ def dhcp_create():
     dhcp = manager.dhcp_create(data=data)
     location = "dhcps/%s" % (dhcp['id'])
     response.set_header("Location", location)
-    clear_cache()
     return dhcp
 
 
@@ -475,7 +588,6 @@ def dhcp_add_vlan(dhcp_id):
     dhcp = manager.dhcp_add_vlan(dhcp_id, data['vlan_id'])
     location = "dhcps/relationship/%s" % (dhcp['id'])
     response.set_header("Location", location)
-    clear_cache()
     return dhcp
 
 
@@ -492,7 +604,6 @@ def dhcp_remove_vlan(dhcp_id, vlan_id):
     """
     manager = create_manager('dhcp')
     dhcp = manager.dhcp_remove_vlan(dhcp_id, vlan_id)
-    clear_cache()
     return dhcp
 
 
@@ -516,7 +627,6 @@ def firewall_create():
     firewall = manager.firewall_create(data=data)
     location = "firewalls/%s" % (firewall['id'])
     response.set_header("Location", location)
-    clear_cache()
     return firewall
 
 
@@ -540,7 +650,6 @@ def router_create():
     router = manager.router_create(data=data)
     location = "routers/%s" % (router['id'])
     response.set_header("Location", location)
-    clear_cache()
     return router
 
 
@@ -676,7 +785,6 @@ def zone_vlan_create():
     vlan = manager.vlan_create(data['zone_id'], data)
     location = "vlans/%s" % (vlan['id'])
     response.set_header("Location", location)
-    clear_cache()
     return vlan
 
 
@@ -700,7 +808,6 @@ def firewall_add_anycast(firewall_id):
     firewall = manager.firewall_add_anycast(firewall_id, data)
     location = "firewall/relationship/%s" % (firewall['id'])
     response.set_header("Location", location)
-    clear_cache()
     return firewall
 
 
@@ -717,7 +824,6 @@ def firewall_remove_anycast(firewall_id, anycast_id):
     """
     manager = create_manager('firewall')
     firewall = manager.firewall_remove_anycast(firewall_id, anycast_id)
-    clear_cache()
     return firewall
 
 
@@ -741,7 +847,6 @@ def anycast_create():
     anycast = manager.anycast_create(data)
     location = "anycasts/%s" % (anycast['id'])
     response.set_header("Location", location)
-    clear_cache()
     return anycast
 
 
@@ -765,7 +870,6 @@ def vlan_subnet_create():
     subnet = manager.subnet_create(data['vlan_id'], data)
     location = "subnets/%s" % (subnet['id'])
     response.set_header("Location", location)
-    clear_cache()
     return subnet
 
 
@@ -789,7 +893,6 @@ def anycast_anycastip_create():
     ip = manager.anycastip_create(data['anycast_id'], data)
     location = "anycastips/%s" % (ip['id'])
     response.set_header("Location", location)
-    clear_cache()
     return ip
 
 
@@ -813,10 +916,49 @@ def subnet_ip_create():
     ip = manager.ip_create(data['subnet_id'], data)
     location = "ips/%s" % (ip['id'])
     response.set_header("Location", location)
-    clear_cache()
     return ip
 
 
+@post('/v1/subnets/<subnet_id>/ips/bulk')
+@handle_auth
+@reply_json
+def subnet_ip_bulk_create(subnet_id):
+    """
+    ::
+
+      POST /v1/subnets/<subnet_id>/ips/bulk
+
+    Create a list or a range of ips in subnet
+    """
+    manager = create_manager('base')
+    data = request.body.readline()
+    if not data:
+        abort(400, 'No data received')
+    data = json.loads(data)
+    ips = manager.ip_create_bulk(subnet_id, data)
+    return ips
+
+
+@post('/v1/subnets/<subnet_id>/ips/allocate')
+@handle_auth
+@reply_json
+def subnet_ip_allocate(subnet_id):
+    """
+    ::
+
+      POST /v1/subnets/<subnet_id>/ips/allocate?count=<count>
+
+    Create the next <count> free ips in subnet
+    """
+    manager = create_manager('base')
+    try:
+        count = int(request.query.get('count', 1))
+    except ValueError:
+        abort(400, 'count must be an integer')
+    ips = manager.ip_allocate(subnet_id, count)
+    return ips
+
+
 @post('/v1/interfaces')
 @handle_auth
 @reply_json
@@ -836,7 +978,6 @@ def interface_create():
     interface = manager.interface_create(data)
     location = "interfaces/%s" % (interface['id'])
     response.set_header("Location", location)
-    clear_cache()
     return interface
 
 
@@ -857,7 +998,6 @@ def interface_add_ip(interface_id):
         abort(400, 'No data received')
     data = json.loads(data)
     interface = manager.interface_add_ip(interface_id, data)
-    clear_cache()
     return interface
 
 
@@ -874,7 +1014,6 @@ def interface_remove_ip(interface_id, ip_id):
     """
     manager = create_manager('base')
     interface = manager.interface_remove_ip(interface_id, ip_id)
-    clear_cache()
     return interface
 
 @post('/v1/interfaces/<interface_id>/vlans')
@@ -894,7 +1033,6 @@ def interface_add_ip(interface_id):
         abort(400, 'No data received')
     data = json.loads(data)
     interface = manager.interface_add_vlan(interface_id, data)
-    clear_cache()
     return interface
 
 
@@ -911,5 +1049,4 @@ def interface_remove_ip(interface_id, vlan_id):
     """
     manager = create_manager('base')
     interface = manager.interface_remove_vlan(interface_id, vlan_id)
-    clear_cache()
     return interface
@@ -28,7 +28,7 @@ from simplenet.exceptions import (
     OperationNotPermited, FeatureNotAvailable
 )
 from simplenet.common.http_utils import (
-    reply_json, create_manager
+    reply_json, create_manager, list_args, info_args
 )
 
 logger = get_logger()
@@ -48,7 +48,7 @@ def firewalls_list():
     manager = create_manager('firewall')
     try:
         _list = getattr(manager, 'firewall_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -65,7 +65,7 @@ def policy_info(owner_type, id):
     Get policy informations
     """
     manager = create_manager('firewall')
-    return manager.policy_info(owner_type, id)
+    return manager.policy_info(owner_type, id, **info_args())
 
 
 @post('/v1/firewalls/policies/<owner_type:re:(?!by).+>/<id>')
@@ -85,6 +85,8 @@ def policy_create(owner_type, id):
         abort(400, 'No data received')
     data = json.loads(data)
     policy = manager.policy_create(owner_type, id, data)
+    if request.query.get('sync'):
+        manager.zones_flush()
     location = "firewalls/policies/%s/%s" % (owner_type, policy['id'])
     response.set_header("Location", location)
     return policy
@@ -102,7 +104,10 @@ def policy_delete(owner_type, id):
     Deletes policy
     """
     manager = create_manager('firewall')
-    return manager.policy_delete(owner_type, id)
+    deleted = manager.policy_delete(owner_type, id)
+    if request.query.get('sync'):
+        manager.zones_flush()
+    return deleted
 
 @get('/v1/firewalls/policies/by-type/<owner_type>')
 @handle_auth
@@ -116,7 +121,7 @@ def policy_list(owner_type):
     Get all policy
     """
     manager = create_manager('firewall')
-    return manager.policy_list(owner_type)
+    return manager.policy_list(owner_type, **list_args())
 
 
 @get('/v1/firewalls/policies/by-owner/<owner_type>/<owner_id>')
@@ -131,4 +136,4 @@ def policy_list_by_owner(owner_type, owner_id):
     Get all policy from a given owner
     """
     manager = create_manager('firewall')
-    return manager.policy_list_by_owner(owner_type, owner_id)
+    return manager.policy_list_by_owner(owner_type, owner_id, **list_args())
@@ -28,7 +28,7 @@ from simplenet.exceptions import (
     OperationNotPermited, FeatureNotAvailable
 )
 from simplenet.common.http_utils import (
-    reply_json, create_manager
+    reply_json, create_manager, list_args
 )
 
 logger = get_logger()
@@ -47,7 +47,7 @@ def switches_list():
     manager = create_manager('switch')
     try:
         _list = getattr(manager, 'switch_list')
-        return _list()
+        return _list(**list_args())
     except AttributeError:
         raise FeatureNotAvailable()
 
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Query count of the _get_data_*_ tree builders as the zone grows.
+
+    $ python try/bench_hierarchy.py
+
+Every column but the timings should stay flat from row to row.
+"""
+
+import benchlib
+benchlib.setup()
+
+from simplenet.db.models import Vlan, Subnet, Ip
+from simplenet.network_appliances.base import Net
+
+
+def main():
+    net = Net()
+    print "%6s %6s | %8s %8s %8s %8s | %10s" % (
+        "vlans", "ips", "ip", "subnet", "vlan", "zone", "zone (ms)")
+    for size in (1, 4, 16, 64):
+        zone_id = benchlib.populate_zone(net.session, "zone%s" % size, size, 2, 16)
+        vlan = net.session.query(Vlan).filter_by(zone_id=zone_id).first()
+        subnet = net.session.query(Subnet).filter_by(vlan_id=vlan.id).first()
+        ip = net.session.query(Ip).filter_by(subnet_id=subnet.id).first()
+
+        counts = [benchlib.measure(f, id)[0] for f, id in (
+            (net._get_data_ip_, ip.id),
+            (net._get_data_subnet_, subnet.id),
+            (net._get_data_vlan_, vlan.id),
+        )]
+        queries, elapsed = benchlib.measure(net._get_data_zone_, zone_id)
+        print "%6s %6s | %8s %8s %8s %8s | %10.1f" % (
+            size, size * 2 * 16, counts[0], counts[1], counts[2],
+            queries, elapsed * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Owning subnet of an address: in-memory prefix index against SQL.
+
+    $ python try/bench_lpm.py
+
+"sql ip row" is how vlan_info_by_ip used to resolve an address, "sql
+range" is the indexed range scan over subnets.first/last and "lpm" is
+the lookup served by simplenet.common.lpm.
+
+The last columns time whole manager calls: Net.prefix_lookup, which
+serves /v1/lookup/<ip>, and vlan_info_by_ip before and after the index,
+with the queries each call runs on average.
+"""
+
+import random
+import time
+
+import benchlib
+benchlib.setup()
+
+from simplenet.common import lpm
+from simplenet.db.models import Subnet, Ip, ip_number
+from simplenet.network_appliances.base import Net
+
+LOOKUPS = 2000
+
+
+def sql_ip_row(net, ip):
+    return net.session.query(Ip).filter_by(ip=ip).first().subnet.vlan_id
+
+
+def sql_range(net, ip):
+    number = ip_number(ip)
+    return net.session.query(Subnet.vlan_id).filter(
+        Subnet.first <= number, Subnet.last >= number
+    ).order_by(Subnet.first.desc(), Subnet.last).limit(1).scalar()
+
+
+def in_memory(net, ip):
+    return lpm.subnets.lookup(ip)['vlan_id']
+
+
+def old_vlan_info_by_ip(net, ip):
+    return net.session.query(Ip).filter_by(ip=ip).first().subnet.vlan.to_dict()
+
+
+def prefix_lookup(net, ip):
+    return net.prefix_lookup(ip)
+
+
+def vlan_info_by_ip(net, ip):
+    return net.vlan_info_by_ip(ip)
+
+
+def timed(net, f, sample):
+    """Average time of f over sample, in us, and its queries per call"""
+    queries = benchlib.queries[0]
+    start = time.time()
+    for ip in sample:
+        f(net, ip)
+    elapsed = time.time() - start
+    net.session.expunge_all()
+    return elapsed / len(sample) * 1000000, float(benchlib.queries[0] - queries) / len(sample)
+
+
+def main():
+    net = Net()
+    print "%8s | %12s %12s %12s | %10s | %16s %16s %16s" % (
+        "subnets", "sql ip row", "sql range", "lpm", "load (ms)",
+        "prefix_lookup", "vlan by ip old", "vlan by ip")
+    subnets = 0
+    for vlans in (4, 16, 64, 256):
+        benchlib.populate_zone(net.session, "zone%s" % vlans, vlans, 4, 4)
+        subnets += vlans * 4
+        ips = [x[0] for x in net.session.query(Ip.ip)]
+        sample = [random.choice(ips) for i in range(LOOKUPS)]
+
+        start = time.time()
+        net.prefix_index_load()
+        load = time.time() - start
+
+        timings = [timed(net, f, sample)[0] for f in (sql_ip_row, sql_range, in_memory)]
+        calls = ["%8.1fus %4.1fq" % timed(net, f, sample)
+                 for f in (prefix_lookup, old_vlan_info_by_ip, vlan_info_by_ip)]
+        print "%8s | %10.1fus %10.1fus %10.1fus | %10.1f | %s" % (
+            subnets, timings[0], timings[1], timings[2], load * 1000, ' '.join(calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Wire size and encode/decode time of the broker payloads of a 10k ip zone,
+for every [event] serializer and compression.
+
+    $ python try/bench_payloads.py
+
+The payloads are the firewall ruleset of the zone, with a policy on every
+tenth ip, and its dhcp entries. Encodings go through kombu as
+EventManager does; msgpack rows are skipped when it is not installed.
+"""
+
+import time
+
+import benchlib
+benchlib.setup()
+
+from kombu.compression import compress, decompress
+from kombu.serialization import encode, decode
+
+from simplenet.db.models import Firewall, Subnet, Ip, Vlan, new_model
+from simplenet.network_appliances.firewall import Net
+
+VLANS, SUBNETS, IPS = 40, 1, 250
+ROUNDS = 5
+ENCODINGS = [(serializer, compression)
+             for serializer in ('json', 'msgpack')
+             for compression in (None, 'zlib', 'bzip2')]
+
+
+def populate(session):
+    zone_id = benchlib.populate_zone(session, 'zone', VLANS, SUBNETS, IPS)
+    session.begin()
+    firewall = Firewall('zone-fw', zone_id, 'FF:FF:FF:FF:FF:FF', True)
+    session.add(firewall)
+    model, _ = new_model('IpPolicy')
+    ips = session.query(Ip).join(Subnet).join(Vlan).filter(Vlan.zone_id == zone_id).all()
+    for x, ip in enumerate(ips[::10]):
+        session.add(model(proto='tcp', src='', src_port='', dst=ip.ip,
+                          dst_port=str(1000 + x % 100), table='INPUT', policy='ACCEPT',
+                          owner_id=ip.id, in_iface='', out_iface=''))
+    session.commit()
+    return zone_id, firewall.id, len(ips)
+
+
+def dhcp_payload(net, zone_id):
+    """What _enqueue_dhcp_entries_ sends, for every vlan of the zone at once"""
+    network, entries = {}, {}
+    for subnet in net.session.query(Subnet).join(Vlan).filter(Vlan.zone_id == zone_id):
+        network[subnet.network()] = {'gateway': subnet.gateway()}
+        for ip in net.ip_list_by_subnet(subnet.id):
+            entries[ip['ip']] = [ip['interface_id'], ip['hostname'] or "defaulthostname"]
+    return {'network': network, 'entries': entries, 'action': 'update'}
+
+
+def timed(f, *args):
+    """Returns the result of f(*args) and its best time of ROUNDS, in ms"""
+    best = None
+    for _ in range(ROUNDS):
+        start = time.time()
+        result = f(*args)
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def encoded(params, serializer, compression):
+    content_type, content_encoding, body = encode(params, serializer=serializer)
+    if compression:
+        body, compressed = compress(body, compression)
+        return content_type, content_encoding, body, compressed
+    return content_type, content_encoding, body, None
+
+
+def decoded(content_type, content_encoding, body, compressed):
+    if compressed:
+        body = decompress(body, compressed)
+    return decode(body, content_type, content_encoding)
+
+
+def main():
+    net = Net()
+    zone_id, firewall_id, ips = populate(net.session)
+    payloads = (
+        ('ruleset', net._get_ruleset_(zone_id, firewall_id)),
+        ('dhcp', dhcp_payload(net, zone_id)),
+    )
+    print "%d ips, best of %d rounds" % (ips, ROUNDS)
+    print "%-8s %-8s %-6s | %10s %6s | %11s %11s" % (
+        "payload", "encoding", "comp", "bytes", "ratio", "encode (ms)", "decode (ms)")
+    for name, params in payloads:
+        plain = None
+        for serializer, compression in ENCODINGS:
+            try:
+                message, encode_ms = timed(encoded, params, serializer, compression)
+            except Exception, e:
+                print "%-8s %-8s %-6s | %s" % (name, serializer, compression or '-', e)
+                continue
+            _, decode_ms = timed(decoded, *message)
+            size = len(message[2])
+            plain = plain or size
+            print "%-8s %-8s %-6s | %10d %5.1f%% | %11.1f %11.1f" % (
+                name, serializer, compression or '-', size, size * 100.0 / plain,
+                encode_ms, decode_ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Helpers shared by the benchmark scripts in this directory.
+
+``setup()`` points simplenet at a throwaway sqlite database before the
+models get imported, so the benchmarks never touch the configured one.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+queries = [0]
+_networks = [0]
+
+
+def setup():
+    from simplenet.common.config import config
+    for section in ('logging', 'server', 'event', 'redis', 'authentication'):
+        if not config.has_section(section):
+            config.add_section(section)
+    config.set('logging', 'level', 'error')
+    config.set('logging', 'file', os.devnull)
+    config.set('server', 'database_type', 'sqlite')
+    config.set('server', 'database_name', tempfile.mktemp(prefix='simplenet-bench-'))
+    config.set('authentication', 'enabled', 'False')
+
+    from sqlalchemy import event
+    from simplenet.db import models
+
+    def _count_(*args, **kwargs):
+        queries[0] += 1
+    event.listen(models.engine, 'before_cursor_execute', _count_)
+
+
+def populate_zone(session, name, vlans, subnets, ips):
+    """Creates a zone with vlans * subnets /24s holding ips addresses each"""
+    from simplenet.db.models import Datacenter, Zone, Vlan, Subnet, Ip, Interface
+    session.begin()
+    datacenter = Datacenter(name='dc-%s' % name)
+    zone = Zone(name=name, datacenter_id=datacenter.id)
+    session.add_all([datacenter, zone])
+    for v in range(vlans):
+        vlan = Vlan(name='%s-vlan%s' % (name, v), zone_id=zone.id,
+                    type='private_vlan', vlan_num=v)
+        session.add(vlan)
+        for s in range(subnets):
+            net = '10.%s.%s' % divmod(_networks[0], 256)
+            _networks[0] += 1
+            subnet = Subnet(cidr='%s.0/24' % net, vlan_id=vlan.id)
+            session.add(subnet)
+            for i in range(ips):
+                ip = Ip(ip='%s.%s' % (net, i + 1), subnet_id=subnet.id)
+                if i % 2:
+                    interface = Interface('%s-%s.%s' % (name, net, i), 'host-%s' % i)
+                    ip.interface_id = interface.id
+                    session.add(interface)
+                session.add(ip)
+    session.commit()
+    return zone.id
+
+
+def measure(f, *args):
+    """Returns (queries, seconds) spent on a single f(*args) call"""
+    queries[0] = 0
+    start = time.time()
+    f(*args)
+    return queries[0], time.time() - start
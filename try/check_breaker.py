@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+State of the redis circuit breaker through failures of every kind.
+
+    $ python try/check_breaker.py
+
+The guarded client is a stub raising what each step asks for, so no
+redis is needed. It fails, exiting 1, when the breaker does not end a
+step in the expected state, such as a half-open trial answered with a
+ResponseError leaving it half-open, rejecting every call for good.
+"""
+
+import sys
+
+import benchlib
+benchlib.setup()
+
+from redis.exceptions import ConnectionError, ResponseError, WatchError
+
+from simplenet.common.breaker import CircuitBreaker, GuardedRedis, CLOSED, OPEN
+
+RESET = 0
+
+
+class Timeout(BaseException):
+    """Like gevent.Timeout, not an Exception"""
+
+
+class Stub(object):
+
+    def get(self, error=None):
+        if error:
+            raise error("failed")
+        return "value"
+
+
+def call(rd, error):
+    try:
+        rd.get(error)
+    except BaseException, e:
+        return type(e).__name__
+    return "ok"
+
+
+# (error raised by redis, state expected after the call)
+STEPS = [
+    (None, CLOSED),
+    (ResponseError, CLOSED),
+    (ConnectionError, OPEN),
+    # Half-open trials, RESET being 0
+    (ResponseError, OPEN),
+    (WatchError, OPEN),
+    (Timeout, OPEN),
+    (ConnectionError, OPEN),
+    (None, CLOSED),
+    (Timeout, CLOSED),
+    (None, CLOSED),
+]
+
+
+def main():
+    breaker = CircuitBreaker('redis', 1, RESET)
+    rd = GuardedRedis(Stub(), breaker)
+    failures = 0
+    print "%-16s %-16s | %-10s %s" % ("raised", "result", "state", "expected")
+    for error, expected in STEPS:
+        result = call(rd, error)
+        ok = breaker.state == expected
+        failures += not ok
+        print "%-16s %-16s | %-10s %-10s %s" % (
+            error.__name__ if error else '-', result, breaker.state, expected,
+            "" if ok else "FAIL")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
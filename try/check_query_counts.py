@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Query count of every list route, in each view, as the tables grow.
+
+    $ python try/check_query_counts.py
+
+Each route is requested against a small and a three times bigger
+database. It fails, exiting 1, when a count grows with the data or goes
+over MAX_QUERIES, which is what a lazy relationship read by to_dict and
+missing from the load_options of its model looks like.
+"""
+
+import sys
+
+import benchlib
+benchlib.setup()
+
+import bottle
+
+from simplenet.common.http_utils import clear_cache
+from simplenet.db.models import (
+    Zone, Vlan, Subnet, Ip, Firewall, Router, Switch, Dhcp, Vlans_to_Dhcp,
+    Anycast, Anycastip, Anycasts_to_Firewall, new_model
+)
+from simplenet.network_appliances.base import Net
+from simplenet.routes import base, policy, switch
+
+MAX_QUERIES = 4
+VIEWS = ('', 'view=summary', 'limit=50', 'fields=id')
+OWNERS = ('datacenter', 'zone', 'vlan', 'subnet', 'ip', 'anycast', 'anycastip')
+
+_anycasts = [0]
+
+
+def populate(session, name, size):
+    zone_id = benchlib.populate_zone(session, name, size, 2, 4)
+    zone = session.query(Zone).get(zone_id)
+    vlans = session.query(Vlan).filter_by(zone_id=zone_id).all()
+    subnet = session.query(Subnet).filter_by(vlan_id=vlans[0].id).first()
+    ip = session.query(Ip).filter_by(subnet_id=subnet.id).first()
+    session.begin()
+    firewall = Firewall('%s-fw' % name, zone_id, 'FF:FF:FF:FF:FF:FF', True)
+    dhcp = Dhcp('%s-dhcp' % name)
+    session.add_all([firewall, dhcp])
+    session.add_all([Router('%s-rt%s' % (name, x), zone_id, '', True) for x in range(size)])
+    session.add_all([Switch('%s-sw%s' % (name, x)) for x in range(size)])
+    session.flush()
+    session.add_all([Vlans_to_Dhcp(vlan_id=x.id, dhcp_id=dhcp.id) for x in vlans])
+    anycast_ids = []
+    for x in range(size):
+        net = '172.16.%s' % _anycasts[0]
+        _anycasts[0] += 1
+        anycast = Anycast('%s.0/24' % net)
+        session.add(anycast)
+        session.flush()
+        anycast_ids.append(anycast.id)
+        session.add(Anycasts_to_Firewall(anycast_id=anycast.id, firewall_id=firewall.id))
+        session.add_all([Anycastip('%s.%s' % (net, y + 1), anycast.id) for y in range(4)])
+    session.flush()
+    anycastip = session.query(Anycastip).filter_by(anycast_id=anycast_ids[0]).first()
+    owners = {
+        'datacenter': zone.datacenter_id, 'zone': zone_id, 'vlan': vlans[0].id,
+        'subnet': subnet.id, 'ip': ip.id, 'anycast': anycast_ids[0],
+        'anycastip': anycastip.id,
+    }
+    for owner_type in OWNERS:
+        model, _ = new_model('%sPolicy' % owner_type.capitalize())
+        for x in range(size):
+            session.add(model(proto='tcp', src='', src_port='', dst='',
+                              dst_port=str(1000 + x), table='INPUT', policy='ACCEPT',
+                              owner_id=owners[owner_type], in_iface='', out_iface=''))
+    session.commit()
+    return [
+        '/v1/datacenters', '/v1/zones', '/v1/vlans', '/v1/subnets', '/v1/anycasts',
+        '/v1/ips', '/v1/anycastips', '/v1/dhcps', '/v1/interfaces', '/v1/firewalls',
+        '/v1/routers', '/v1/switches',
+        '/v1/zones/list-by-datacenter/%s' % zone.datacenter_id,
+        '/v1/vlans/list-by-zone/%s' % zone_id,
+        '/v1/vlans/list-by-dhcp/%s' % dhcp.id,
+        '/v1/subnets/list-by-vlan/%s' % vlans[0].id,
+        '/v1/ips/list-by-subnet/%s' % subnet.id,
+        '/v1/anycasts/list-by-firewall/%s' % firewall.id,
+        '/v1/anycastips/list-by-anycast/%s' % anycast_ids[0],
+        '/v1/firewalls/list-by-zone/%s' % zone_id,
+        '/v1/routers/list-by-zone/%s' % zone_id,
+        '/v1/dhcps/list-by-vlan/%s' % vlans[0].id,
+    ] + ['/v1/firewalls/policies/by-type/%s' % x for x in OWNERS] + [
+        '/v1/firewalls/policies/by-owner/%s/%s' % (x, owners[x]) for x in OWNERS
+    ]
+
+
+def request(app, path, query_string):
+    """Returns the query count and the status of a GET, body included"""
+    try:
+        clear_cache()
+    except Exception:
+        pass
+    status = []
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query_string,
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '8081', 'wsgi.url_scheme': 'http',
+    }
+    queries, elapsed = benchlib.measure(
+        lambda: ''.join(app(environ, lambda x, headers: status.append(x)))
+    )
+    return queries, status[0]
+
+
+def main():
+    app = bottle.app()
+    net = Net()
+    small = populate(net.session, 'small', 2)
+    big = populate(net.session, 'big', 6)
+    failures = 0
+    print "%-52s %-14s | %5s %5s" % ("route", "query", "small", "big")
+    for small_path, big_path in zip(small, big):
+        for view in VIEWS:
+            counts = []
+            for path in (small_path, big_path):
+                queries, status = request(app, path, view)
+                if not status.startswith('200'):
+                    queries = status
+                counts.append(queries)
+            if counts[0] == counts[1] == '400 Bad Request' and 'fields' in view:
+                # Association rows (vlans/list-by-dhcp, ...) have no id
+                continue
+            ok = counts[0] == counts[1] and counts[0] <= MAX_QUERIES
+            failures += not ok
+            route = small_path
+            if len(route.rsplit('/', 1)[1]) == 36:
+                route = route.rsplit('/', 1)[0] + '/<id>'
+            print "%-52s %-14s | %5s %5s %s" % (
+                route, view, counts[0], counts[1], "" if ok else "FAIL")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
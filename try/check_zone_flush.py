@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+# Copyright 2012 Locaweb.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Rulesets of a zone whose push failed get pushed again on their own.
+
+    $ python try/check_zone_flush.py
+
+A policy change is made while pushing the rulesets fails FAILURES times,
+in the window of RECOMPILE_WINDOW and with synchronous pushes. It fails,
+exiting 1, when no push reaches the firewalls of the zone within
+TIMEOUT seconds, or when the tables of the failed pushes are lost.
+"""
+
+import sys
+import time
+
+import benchlib
+benchlib.setup()
+
+from simplenet.db.models import Firewall, OutboxEvent
+from simplenet.network_appliances import firewall
+
+FAILURES = 3
+TIMEOUT = 5
+
+firewall.FLUSH_RETRY = 0.1
+
+
+class FlakyNet(firewall.Net):
+    """Fails the first failures pushes, then records the tables pushed"""
+
+    failures = [0]
+    pushed = []
+
+    def _enqueue_device_rules_(self, data, devices, owner_type):
+        if self.failures[0] > 0:
+            self.failures[0] -= 1
+            raise Exception("database went away")
+        self.pushed.append(data['tables'])
+        return super(FlakyNet, self)._enqueue_device_rules_(data, devices, owner_type)
+
+
+def policy(table, port):
+    return {'proto': 'tcp', 'src': '', 'src_port': '', 'dst': '', 'dst_port': str(port),
+            'table': table, 'policy': 'ACCEPT', 'in_iface': '', 'out_iface': ''}
+
+
+def check(net, zone_id, window, tables, ports):
+    firewall.RECOMPILE_WINDOW = window
+    FlakyNet.failures[0] = FAILURES
+    del FlakyNet.pushed[:]
+    events = net.session.query(OutboxEvent).count()
+    for port, table in zip(ports, tables):
+        try:
+            net.policy_create('zone', zone_id, policy(table, port))
+        except Exception:
+            # Synchronous pushes raise their failure
+            pass
+    deadline = time.time() + TIMEOUT
+    while not FlakyNet.pushed and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.2)
+    pushed = sorted(set(sum(FlakyNet.pushed, [])))
+    ok = pushed == sorted(set(tables)) and net.session.query(OutboxEvent).count() > events
+    print "%-6s %-24s | %-24s %s" % (window, ','.join(tables), ','.join(pushed), "" if ok else "FAIL")
+    return ok
+
+
+def main():
+    net = FlakyNet()
+    # Timers push through firewall.Net, the flaky one is what they get
+    firewall.Net = FlakyNet
+    zone_id = benchlib.populate_zone(net.session, 'zone', 1, 1, 1)
+    net.session.begin()
+    net.session.add(Firewall('zone-fw', zone_id, 'FF:FF:FF:FF:FF:FF', True))
+    net.session.commit()
+    print "%-6s %-24s | %-24s" % ("window", "tables changed", "tables pushed")
+    failures = 0
+    failures += not check(net, zone_id, 0.2, ['INPUT', 'FORWARD'], [1, 2])
+    failures += not check(net, zone_id, 0, ['INPUT', 'OUTPUT'], [3, 4])
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()